@@ -28,6 +28,7 @@ from vsc.config.base import VSC_CONF_DEFAULT_FILENAME
 from vsc.accountpage.client import AccountpageClient
 
 from vsc.administration.ldapsync import LdapSyncer, ERROR
+from vsc.administration.httpcache import install_http_cache, ACCOUNTPAGE_HTTP_CACHE_DIR
 
 from vsc.ldap.configuration import VscConfiguration
 from vsc.utils.timestamp import convert_timestamp, read_timestamp, write_timestamp
@@ -52,6 +53,8 @@ def main():
         'start-timestamp': ("The timestamp form which to start, otherwise use the cached value", None, "store", None),
         'access_token': ('OAuth2 token identifying the user with the accountpage', None, 'store', None),
         'account_page_url': ('url for the account page', None, 'store', None),
+        'http_cache': ('Directory for the conditional GET cache of the account page (e.g., %s), '
+                       'disabled if not given' % ACCOUNTPAGE_HTTP_CACHE_DIR, str, 'store', None),
         }
     # get access_token from conf file
     ExtendedSimpleOption.CONFIGFILES_INIT = ['/etc/account_page.conf']
@@ -104,6 +107,8 @@ def main():
                 _log.raiseException("Could not drop privileges")
 
             client = AccountpageClient(token=opts.options.access_token, url=opts.options.account_page_url + '/api/')
+            if opts.options.http_cache:
+                install_http_cache(client, opts.options.http_cache)
             syncer = LdapSyncer(client)
             last = int((datetime.datetime.strptime(last_timestamp, "%Y%m%d%H%M%SZ") -
                        datetime.datetime(1970, 1, 1)).total_seconds())
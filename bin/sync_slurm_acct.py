@@ -19,18 +19,29 @@ This script synchronises the users and VO's from the HPC account page to the Slu
 The script must result in an idempotent execution, to ensure nothing breaks.
 """
 
+import json
 import logging
 import sys
+import threading
+import time
+
+from datetime import datetime
 
 from vsc.accountpage.client import AccountpageClient
 from vsc.accountpage.wrappers import mkVo
-from vsc.administration.slurm.sync import get_slurm_acct_info, SyncTypes, SacctMgrException
+from vsc.administration.httpcache import install_http_cache, ACCOUNTPAGE_HTTP_CACHE_DIR
+from vsc.administration.slurm.sync import get_slurm_association_info, SacctMgrException, SlurmAssociationIndex
 from vsc.administration.slurm.sync import slurm_institute_accounts, slurm_vo_accounts, slurm_user_accounts
+from vsc.administration.slurm.sync import coalesce_commands, execute_command_plan, SacctMgrSession
+from vsc.administration.slurm.sync import desired_state_fingerprint, get_slurm_transactions
+from vsc.administration.slurm.sync import slurm_stale_accounts, slurm_vo_fairshare, SLURM_MAX_STALE_ACCOUNTS
+from vsc.administration.slurm.sync import verify_command_plan, SlurmSyncVerificationError
 from vsc.config.base import GENT_SLURM_COMPUTE_CLUSTERS, GENT_PRODUCTION_COMPUTE_CLUSTERS
 from vsc.utils import fancylogger
 from vsc.utils.nagios import NAGIOS_EXIT_CRITICAL
 from vsc.utils.run import RunQA, RunQAStdout
 from vsc.utils.script_tools import ExtendedSimpleOption
+from vsc.utils.timestamp import convert_timestamp, convert_to_unix_timestamp, read_timestamp, write_timestamp
 
 logger = fancylogger.getLogger()
 fancylogger.logToScreen(True)
@@ -44,19 +55,129 @@ NAGIOS_HEADER = "sync_slurm_acct"
 NAGIOS_CHECK_INTERVAL_THRESHOLD = 60 * 60  # 60 minutes
 
 SYNC_TIMESTAMP_FILENAME = "/var/cache/%s.timestamp" % (NAGIOS_HEADER)
+SYNC_FINGERPRINT_FILENAME = "/var/cache/%s.fingerprint" % (NAGIOS_HEADER)
 SYNC_SLURM_ACCT_LOGFILE = "/var/log/%s.log" % (NAGIOS_HEADER)
 
+STALE_ACCOUNTS_SKIPPED_WARNING = 1
+
+
+def execute_commands(commands, session=False, parallel=1):
+    """Run the specified commands
 
-def execute_commands(commands):
-    """Run the specified commands"""
+    By default, each command runs in its own sacctmgr process and its exit code is checked.
+
+    @param session: feed the commands to a single interactive sacctmgr session instead. The session
+                    can only detect failures from the error messages in its output (see SacctMgrSession).
+    @param parallel: maximal number of commands running concurrently; with a session, each worker has its own
+    """
+    local = threading.local()
+    sessions = []
 
-    for command in commands:
+    def run(command):
         logging.info("Running command: %s", command)
 
         # if one fails, we simply fail the script and should get notified
-        (ec, _) = RunQA.run(command, qa={"(N/y):": "y"}, add_newline=False)
-        if ec != 0:
-            raise SacctMgrException("Command failed: {0}".format(command))
+        if session:
+            if not hasattr(local, "session"):
+                local.session = SacctMgrSession()
+                sessions.append(local.session)
+            local.session.run(command)
+        else:
+            (ec, _) = RunQA.run(command, qa={"(N/y):": "y"}, add_newline=False)
+            if ec != 0:
+                raise SacctMgrException("Command failed: {0}".format(command))
+
+    try:
+        execute_command_plan(commands, run, parallel)
+    finally:
+        for session in sessions:
+            session.close()
+
+
+def read_fingerprint(filename):
+    """Read the fingerprint of the last applied state.
+
+    @returns: dict with the desired state digest and the time the Slurm state was known, or None
+    """
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        logging.warning("Could not read the fingerprint from %s", filename)
+        return None
+
+
+def write_fingerprint(filename, desired, timestamp, clusters):
+    """Write the fingerprint of the applied state.
+
+    @param desired: digest of the applied desired state, None if it is unknown (i.e., after an incremental run)
+    @param timestamp: unix timestamp at which the Slurm state was read or verified after applying the plan
+    @param clusters: the clusters that were synced
+    """
+    with open(filename, 'w') as f:
+        json.dump({"desired": desired, "timestamp": timestamp, "clusters": sorted(clusters)}, f)
+
+
+def get_account_page_full(client):
+    """Fetch all VOs and the active accounts from the account page.
+
+    @returns: tuple (VOs, active accounts)
+    """
+    # All users belong to a VO, so fetching the VOs is necessary/
+    account_page_vos = [mkVo(v) for v in client.vo.get()[1]]
+
+    # The VOs do not track active state of users, so we need to fetch all accounts as well
+    active_accounts = set([a["vsc_id"] for a in client.account.get()[1] if a["isactive"]])
+
+    return (account_page_vos, active_accounts)
+
+
+def get_account_page_modified(client, last_timestamp):
+    """Fetch the VOs and accounts that were modified in the account page since the given timestamp.
+
+    @param last_timestamp: unix timestamp of the last successful sync
+
+    @returns: tuple (modified VOs, modified accounts)
+    """
+    modified_vos = [mkVo(v) for v in client.vo.modified[last_timestamp].get()[1]]
+    modified_accounts = client.account.modified[last_timestamp].get()[1]
+
+    logging.info("Found %d modified VOs and %d modified accounts since %s",
+                 len(modified_vos), len(modified_accounts), last_timestamp)
+
+    return (modified_vos, modified_accounts)
+
+
+def get_affected_users(client, modified_vos, modified_accounts, slurm_users):
+    """Determine the users affected by the modifications in the account page.
+
+    The active accounts are fetched in full, so active accounts that are missing from the Slurm DB (e.g., because
+    adding them failed in an earlier run) and Slurm users whose account is no longer active are affected as well.
+    Only when such an account is not a member of any modified VO, all the VOs are fetched to find the user's VO.
+
+    @param slurm_users: set of users currently present in the Slurm DB
+
+    @returns: tuple (VOs, active accounts, affected users)
+    """
+    active_accounts = set([a["vsc_id"] for a in client.account.get()[1] if a["isactive"]])
+    modified_vo_members = set([m for vo in modified_vos for m in vo.members])
+    new_accounts = active_accounts - slurm_users
+
+    if new_accounts - modified_vo_members:
+        logging.info("%d new accounts do not belong to a modified VO, fetching all VOs",
+                     len(new_accounts - modified_vo_members))
+        account_page_vos = [mkVo(v) for v in client.vo.get()[1]]
+    else:
+        account_page_vos = modified_vos
+
+    affected_users = (
+        modified_vo_members |
+        set([a["vsc_id"] for a in modified_accounts]) |
+        new_accounts |
+        (slurm_users - active_accounts)
+    )
+
+    return (account_page_vos, active_accounts, affected_users)
 
 
 def main():
@@ -80,54 +201,155 @@ def main():
             "store",
             None,
         ),
+        "sacctmgr_session": (
+            "Feed the sacctmgr commands to a single interactive session instead of a process per command "
+            "(failures are detected from the error messages, not from an exit code)",
+            None,
+            "store_true",
+            False,
+        ),
+        "parallel": (
+            "Maximal number of sacctmgr commands running concurrently",
+            int,
+            "store",
+            1,
+        ),
+        "max_stale_accounts": (
+            "Maximal number of stale VO accounts removed from Slurm in a single (full) sync",
+            int,
+            "store",
+            SLURM_MAX_STALE_ACCOUNTS,
+        ),
+        "http_cache": (
+            "Directory for the conditional GET cache of the account page (e.g., %s), disabled if not given" %
+            ACCOUNTPAGE_HTTP_CACHE_DIR,
+            str,
+            "store",
+            None,
+        ),
+        "full_sync": (
+            "Synchronise all VOs and accounts instead of only those modified since the last run",
+            None,
+            "store_true",
+            False,
+        ),
     }
 
     opts = ExtendedSimpleOption(options)
     stats = {}
 
     try:
+        now = datetime.utcnow()
+        start_time = int(time.time())
         client = AccountpageClient(token=opts.options.access_token, url=opts.options.account_page_url + "/api/")
-
-        last_timestamp = "201804010000Z"  # the beginning of time
-
-        logging.info("Last recorded timestamp was %s" % (last_timestamp))
-
-        slurm_account_info = get_slurm_acct_info(SyncTypes.accounts)
-        slurm_user_info = get_slurm_acct_info(SyncTypes.users)
-
-        logging.debug("%d accounts found", len(slurm_account_info))
-        logging.debug("%d users found", len(slurm_user_info))
+        if opts.options.http_cache:
+            install_http_cache(client, opts.options.http_cache)
 
         if opts.options.clusters is not None:
             clusters = opts.options.clusters.split(",")
+            fingerprint = None
         else:
             clusters = [c for c in GENT_SLURM_COMPUTE_CLUSTERS if c in GENT_PRODUCTION_COMPUTE_CLUSTERS]
+            fingerprint = read_fingerprint(SYNC_FINGERPRINT_FILENAME)
+            if fingerprint is not None and fingerprint.get("clusters") != sorted(clusters):
+                logging.info("The clusters changed since the last sync, doing a full sync")
+                fingerprint = None
+
+        # the timestamp only covers the clusters of the last sync, a sync restricted to some
+        # (possibly never synced) clusters or one for a different set of clusters starts from scratch
+        last_timestamp = None
+        if opts.options.full_sync:
+            logging.info("Full sync requested")
+        elif fingerprint is None:
+            logging.info("No fingerprint of the last sync for clusters %s, doing a full sync", ",".join(clusters))
+        else:
+            try:
+                last_timestamp = read_timestamp(SYNC_TIMESTAMP_FILENAME)
+                logging.info("Last recorded timestamp was %s" % (last_timestamp))
+            except Exception:
+                logger.exception("Something broke reading the timestamp from %s, doing a full sync",
+                                 SYNC_TIMESTAMP_FILENAME)
+
+        # nothing changed in the Slurm DB since the state was last read
+        slurm_unchanged = fingerprint is not None and not get_slurm_transactions(fingerprint["timestamp"])
+        if not slurm_unchanged and last_timestamp is not None:
+            # the modifications in the account page do not tell what changed in the Slurm DB
+            logging.info("The Slurm DB changed since the last sync, doing a full sync")
+            last_timestamp = None
+
+        if last_timestamp is None:
+            (account_page_vos, active_accounts) = get_account_page_full(client)
+            desired = desired_state_fingerprint(account_page_vos, active_accounts, clusters)
+            desired_unchanged = fingerprint is not None and fingerprint["desired"] == desired
+        else:
+            (modified_vos, modified_accounts) = get_account_page_modified(
+                client,
+                convert_to_unix_timestamp(last_timestamp),
+            )
+            desired = fingerprint and fingerprint["desired"]
+            desired_unchanged = not (modified_vos or modified_accounts)
+            if not desired_unchanged:
+                desired = None
 
         sacctmgr_commands = []
 
-        # make sure the institutes and the default accounts (VOs) are there for each cluster
-        sacctmgr_commands += slurm_institute_accounts(slurm_account_info, clusters)
-
-        # All users belong to a VO, so fetching the VOs is necessary/
-        account_page_vos = [mkVo(v) for v in client.vo.get()[1]]
-
-        # The VOs do not track active state of users, so we need to fetch all accounts as well
-        active_accounts = set([a["vsc_id"] for a in client.account.get()[1] if a["isactive"]])
-
-        # dictionary mapping the VO vsc_id on a tuple with the VO members and the VO itself
-        account_page_members = dict([(vo.vsc_id, (set(vo.members), vo)) for vo in account_page_vos])
-
-        # process all regular VOs
-        sacctmgr_commands += slurm_vo_accounts(account_page_vos, slurm_account_info, clusters)
-
-        # process VO members
-        sacctmgr_commands += slurm_user_accounts(
-            account_page_members,
-            active_accounts,
-            slurm_user_info,
-            clusters,
-            opts.options.dry_run
-        )
+        if slurm_unchanged and desired_unchanged:
+            logging.info("Neither the account page nor the Slurm DB changed since the last sync")
+        else:
+            (slurm_account_info, slurm_user_info) = get_slurm_association_info(clusters)
+
+            logging.debug("%d accounts found", len(slurm_account_info))
+            logging.debug("%d users found", len(slurm_user_info))
+
+            slurm_index = SlurmAssociationIndex(slurm_account_info, slurm_user_info)
+
+            if last_timestamp is None:
+                affected_users = None
+            else:
+                slurm_users = set()
+                for cluster in clusters:
+                    slurm_users |= slurm_index.cluster_users(cluster)
+                (account_page_vos, active_accounts, affected_users) = get_affected_users(
+                    client,
+                    modified_vos,
+                    modified_accounts,
+                    slurm_users,
+                )
+
+            # make sure the institutes and the default accounts (VOs) are there for each cluster
+            sacctmgr_commands += slurm_institute_accounts(slurm_index, clusters)
+
+            # dictionary mapping the VO vsc_id on a tuple with the VO members and the VO itself
+            account_page_members = dict([(vo.vsc_id, (set(vo.members), vo)) for vo in account_page_vos])
+
+            # process all regular VOs
+            sacctmgr_commands += slurm_vo_accounts(account_page_vos, slurm_index, clusters)
+            sacctmgr_commands += slurm_vo_fairshare(account_page_vos, slurm_index, clusters)
+
+            # process VO members
+            sacctmgr_commands += slurm_user_accounts(
+                account_page_members,
+                active_accounts,
+                slurm_index,
+                clusters,
+                opts.options.dry_run,
+                affected_users,
+            )
+
+            # remove the accounts of deleted VOs, this needs the complete VO listing
+            if affected_users is None:
+                (stale_commands, stale_skipped) = slurm_stale_accounts(
+                    account_page_vos,
+                    slurm_index,
+                    clusters,
+                    opts.options.max_stale_accounts,
+                )
+                sacctmgr_commands += stale_commands
+                # too many stale accounts need a look by hand, the rest of the sync goes ahead
+                stats["stale_accounts_skipped"] = stale_skipped
+                stats["stale_accounts_skipped_warning"] = STALE_ACCOUNTS_SKIPPED_WARNING
+
+            sacctmgr_commands = coalesce_commands(sacctmgr_commands)
 
         logging.info("Executing %d commands", len(sacctmgr_commands))
 
@@ -135,7 +357,32 @@ def main():
             print("Commands to be executed:\n")
             print("\n".join([" ".join(c) for c in sacctmgr_commands]))
         else:
-            execute_commands(sacctmgr_commands)
+            # the Slurm state was read after start_time; when nobody else changed the Slurm DB since then,
+            # the verified state after applying the plan is known and our own commands need not force a full sync
+            state_time = start_time
+            slurm_untouched = sacctmgr_commands and not get_slurm_transactions(start_time)
+
+            execute_commands(sacctmgr_commands, opts.options.sacctmgr_session, opts.options.parallel)
+
+            # only the touched users and accounts are queried, the rest of the state was just read
+            mismatches = verify_command_plan(sacctmgr_commands)
+            stats["verification_mismatches"] = len(mismatches)
+            if mismatches:
+                for mismatch in mismatches:
+                    logging.error("Verification failed: %s", mismatch)
+                raise SlurmSyncVerificationError("%d associations do not match the plan" % len(mismatches))
+
+            if slurm_untouched:
+                # transactions are listed per second, our last command must fall before the recorded time
+                time.sleep(1)
+                state_time = int(time.time())
+
+            # a run restricted to some clusters does not bring the other clusters up to date
+            if opts.options.clusters is None:
+                (_, ldap_timestamp) = convert_timestamp(now)
+                write_timestamp(SYNC_TIMESTAMP_FILENAME, ldap_timestamp)
+                # changes made after state_time show up as transactions and make the next run a full sync
+                write_fingerprint(SYNC_FINGERPRINT_FILENAME, desired, state_time, clusters)
 
     except Exception as err:
         logger.exception("critical exception caught: %s" % (err))
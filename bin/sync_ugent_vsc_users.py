@@ -34,6 +34,8 @@ from datetime import datetime
 
 from vsc.accountpage.client import AccountpageClient
 from vsc.accountpage.wrappers import mkVscUserSizeQuota
+from vsc.administration.httpcache import install_http_cache, ACCOUNTPAGE_HTTP_CACHE_DIR
+from vsc.administration.tools import ProvisioningContext, FS_WORKERS, REST_WORKERS
 from vsc.administration.user import process_users, process_users_quota
 from vsc.administration.vo import process_vos
 from vsc.config.base import GENT
@@ -84,6 +86,10 @@ def main():
         'access_token': ('OAuth2 token to access the account page REST API', None, 'store', None),
         'account_page_url': ('URL of the account page where we can find the REST API', None, 'store', None),
         'host_institute': ('Name of the institute where this script is being run', str, 'store', GENT),
+        'http_cache': ('Directory for the conditional GET cache of the account page (e.g., %s), '
+                       'disabled if not given' % ACCOUNTPAGE_HTTP_CACHE_DIR, str, 'store', None),
+        'rest_workers': ('Number of concurrent requests to the account page REST API', int, 'store', REST_WORKERS),
+        'fs_workers': ('Number of users that are provisioned concurrently on a filesystem', int, 'store', FS_WORKERS),
     }
 
     opts = ExtendedSimpleOption(options)
@@ -92,6 +98,8 @@ def main():
     try:
         now = datetime.utcnow()
         client = AccountpageClient(token=opts.options.access_token, url=opts.options.account_page_url + "/api/")
+        if opts.options.http_cache:
+            install_http_cache(client, opts.options.http_cache)
 
         try:
             last_timestamp = read_timestamp(SYNC_TIMESTAMP_FILENAME)
@@ -102,6 +110,8 @@ def main():
         logger.info("Last recorded timestamp was %s" % (last_timestamp))
         last_timestamp = convert_to_unix_timestamp(last_timestamp)
 
+        context = ProvisioningContext(dry_run=opts.options.dry_run)
+
         (users_ok, users_fail) = ([], [])
         (quota_ok, quota_fail) = ([], [])
         if opts.options.user:
@@ -118,7 +128,11 @@ def main():
                                                        ugent_accounts,
                                                        storage_name,
                                                        client,
-                                                       opts.options.host_institute)
+                                                       opts.options.host_institute,
+                                                       rest_workers=opts.options.rest_workers,
+                                                       context=context,
+                                                       fs_workers=opts.options.fs_workers,
+                                                       accounts=ugent_changed_accounts)
                 stats["%s_users_sync" % (storage_name,)] = len(users_ok)
                 stats["%s_users_sync_fail" % (storage_name,)] = len(users_fail)
                 stats["%s_users_sync_fail_warning" % (storage_name,)] = STORAGE_USERS_LIMIT_WARNING
@@ -134,7 +148,9 @@ def main():
                                                                          storage_changed_quota,
                                                                          storage_name,
                                                                          client,
-                                                                         opts.options.host_institute)
+                                                                         opts.options.host_institute,
+                                                                         rest_workers=opts.options.rest_workers,
+                                                                         context=context)
                 stats["%s_quota_sync" % (storage_name,)] = len(quota_ok)
                 stats["%s_quota_sync_fail" % (storage_name,)] = len(quota_fail)
                 stats["%s_quota_sync_fail_warning" % (storage_name,)] = STORAGE_QUOTA_LIMIT_WARNING
@@ -160,12 +176,20 @@ def main():
                                                  storage_name,
                                                  client,
                                                  last_timestamp,
-                                                 opts.options.host_institute)
+                                                 opts.options.host_institute,
+                                                 rest_workers=opts.options.rest_workers,
+                                                 context=context)
                 stats["%s_vos_sync" % (storage_name,)] = len(vos_ok)
                 stats["%s_vos_sync_fail" % (storage_name,)] = len(vos_fail)
                 stats["%s_vos_sync_fail_warning" % (storage_name,)] = STORAGE_VO_LIMIT_WARNING
                 stats["%s_vos_sync_fail_critical" % (storage_name,)] = STORAGE_VO_LIMIT_CRITICAL
 
+        # quota (of users and VOs) that differed from the GPFS limits and were written, or were left alone
+        for storage_name in opts.options.storage:
+            device = context.storage[storage_name].filesystem
+            stats["%s_quota_drift" % (storage_name,)] = context.quota_writer.drift[device]
+            stats["%s_quota_unchanged" % (storage_name,)] = context.quota_writer.unchanged[device]
+
         if not (users_fail or quota_fail or vos_fail):
             (_, ldap_timestamp) = convert_timestamp(now)
             if not opts.options.dry_run:
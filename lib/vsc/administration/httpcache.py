@@ -0,0 +1,176 @@
+#
+# Copyright 2018-2018 Ghent University
+#
+# This file is part of vsc-administration,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-administration
+#
+# All rights reserved.
+#
+"""
+On-disk HTTP cache for the account page REST API.
+
+GET responses that carry an ETag or Last-Modified header are stored together with these validators.
+The next GET for the same URL is sent as a conditional request (If-None-Match, If-Modified-Since) and a
+304 Not Modified answer is served from the store, so unchanged listings are not transferred again.
+
+The stored responses hold account information, so the cache is only used when it is asked for and its
+directory and files are only accessible by the owner.
+
+    client = AccountpageClient(token=..., url=...)
+    install_http_cache(client, ACCOUNTPAGE_HTTP_CACHE_DIR)
+"""
+import errno
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+from urllib2 import HTTPError
+
+ACCOUNTPAGE_HTTP_CACHE_DIR = "/var/cache/accountpage_http"
+
+# the modified listings change URL with every timestamp, storing them would only fill up the disk
+UNCACHED_URL_PARTS = ["/modified/"]
+
+
+class CachedResponse(object):
+    """A connection-like object for a response body that was already read."""
+
+    def __init__(self, code, body, headers=None):
+        self.code = code
+        self._body = body
+        self._headers = headers or {}
+
+    def read(self):
+        return self._body
+
+    def info(self):
+        return self._headers
+
+    def close(self):
+        pass
+
+
+class HttpCache(object):
+    """
+    Store for GET response bodies and their validators, one JSON file per URL.
+
+    Files are replaced atomically, so several threads or processes can share the store. A store
+    that cannot be read or written only costs a full request.
+    """
+
+    def __init__(self, path=ACCOUNTPAGE_HTTP_CACHE_DIR):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+
+    def _filename(self, url):
+        return os.path.join(self.path, hashlib.sha1(url).hexdigest() + ".json")
+
+    def get(self, url):
+        """
+        Return the stored entry for the given URL.
+
+        @returns: dict with the url, etag, last_modified and body, or None
+        """
+        try:
+            with open(self._filename(url)) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        if entry.get("url") != url:
+            return None
+        return entry
+
+    def put(self, url, etag, last_modified, body):
+        """Store the body of the response for the given URL with its validators."""
+        try:
+            os.makedirs(self.path, 0o700)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                logging.warning("Cannot create the HTTP cache directory %s: %s", self.path, err)
+                return
+
+        entry = {
+            "url": url,
+            "etag": etag,
+            "last_modified": last_modified,
+            "body": body,
+        }
+        try:
+            (fd, tmp) = tempfile.mkstemp(dir=self.path)
+            os.fchmod(fd, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump(entry, f)
+            os.rename(tmp, self._filename(url))
+        except (IOError, OSError) as err:
+            logging.warning("Cannot store the response for %s in the HTTP cache: %s", url, err)
+
+    def conditional_headers(self, entry):
+        """Return the headers that make a GET for the stored entry conditional."""
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+
+def cacheable(method, url):
+    """Only plain GET listings and resources are cached."""
+    return method == "GET" and not [part for part in UNCACHED_URL_PARTS if part in url]
+
+
+def install_http_cache(client, path=ACCOUNTPAGE_HTTP_CACHE_DIR):
+    """
+    Make the given RestClient (e.g., an AccountpageClient) send conditional GETs backed by an on-disk cache.
+
+    The connections of the underlying vsc.utils.rest.Client are wrapped; other requests are not affected.
+
+    @returns: the HttpCache instance, e.g., to report the hits and misses
+    """
+    cache = HttpCache(path)
+    rest_client = client.client
+    get_connection = rest_client.get_connection
+
+    def cached_get_connection(method, url, body, headers):
+        if not cacheable(method, url):
+            return get_connection(method, url, body, headers)
+
+        full_url = rest_client.url + url
+        entry = cache.get(full_url)
+        if entry is not None:
+            headers = dict(headers)
+            headers.update(cache.conditional_headers(entry))
+
+        try:
+            connection = get_connection(method, url, body, headers)
+        except HTTPError as err:
+            if err.code == 304 and entry is not None:
+                logging.debug("Not modified, serving %s from the HTTP cache", full_url)
+                cache.hits += 1
+                return CachedResponse(200, entry["body"].encode("utf-8"))
+            raise
+
+        cache.misses += 1
+        response_body = connection.read()
+        response_headers = connection.info()
+        connection.close()
+
+        etag = response_headers.get("ETag")
+        last_modified = response_headers.get("Last-Modified")
+        if connection.code == 200 and (etag or last_modified):
+            cache.put(full_url, etag, last_modified, response_body.decode("utf-8"))
+
+        return CachedResponse(connection.code, response_body, response_headers)
+
+    rest_client.get_connection = cached_get_connection
+    return cache
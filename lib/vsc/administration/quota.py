@@ -0,0 +1,316 @@
+#
+# Copyright 2018-2018 Ghent University
+#
+# This file is part of vsc-administration,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-administration
+#
+# All rights reserved.
+#
+"""
+Batched GPFS quota changes.
+
+Setting the quota through GpfsOperations runs one mm command per user or fileset, and each of these
+is a round trip to the cluster manager. The QuotaWriter collects the quota changes per filesystem
+and applies them with a single mmsetquota -F stanza file (split into chunks for large batches).
+
+The current limits of a filesystem can be read with one mmrepquota listing into a QuotaIndex. A writer
+with an index only writes the changes that differ from what GPFS already enforces (the drift).
+
+GracePeriods sets the grace time of each fileset only once per run.
+
+    writer = QuotaWriter(gpfs, fileset_inventory, index=QuotaIndex())
+    writer.set_user_quota('kyukondata', '/gpfs/kyukondata/gent/vo/000/gvo00002', 2540075, soft, hard)
+    writer.set_fileset_quota('kyukondata', 'gvo00002', soft, hard)
+    failed = writer.flush()
+"""
+import logging
+import os
+import tempfile
+import threading
+
+from collections import Counter, namedtuple, OrderedDict
+
+from vsc.utils.run import RunNoShell
+
+MMSETQUOTA = "/usr/lpp/mmfs/bin/mmsetquota"
+MMREPQUOTA = "/usr/lpp/mmfs/bin/mmrepquota"
+
+# maximal number of quota stanzas in a single mmsetquota -F call
+QUOTA_STANZA_CHUNK_SIZE = 1000
+
+USER_QUOTA = "USR"
+FILESET_QUOTA = "FILESET"
+
+# owner is what the caller wants back when the change cannot be applied, e.g., the user or VO ID
+QuotaChange = namedtuple('QuotaChange', ['typ', 'id', 'fileset', 'soft', 'hard', 'owner'])
+
+
+def parse_mmrepquota(lines):
+    """
+    Parse the mmrepquota -Y listing.
+
+    @returns: dict mapping (quota type, id, fileset) on the (soft, hard) block limits in KiB. The id is the
+              numerical user ID for USR quota and the fileset name for FILESET quota, the fileset is None
+              for the latter and for USR quota that are not per fileset.
+    """
+    limits = {}
+    header = None
+    for line in lines:
+        fields = line.strip().split(":")
+        if len(fields) < 3 or not fields[0].startswith("mmrepquota"):
+            continue
+        if fields[2] == "HEADER":
+            header = dict([(name, index) for (index, name) in enumerate(fields)])
+            continue
+        if header is None:
+            continue
+
+        try:
+            typ = fields[header['quotaType']]
+            soft = int(fields[header['blockQuota']])
+            hard = int(fields[header['blockLimit']])
+            if typ == USER_QUOTA:
+                fileset = fields[header['filesetname']] if 'filesetname' in header else None
+                key = (typ, int(fields[header['id']]), fileset or None)
+            elif typ == FILESET_QUOTA:
+                key = (typ, fields[header['name']], None)
+            else:
+                continue
+        except (IndexError, KeyError, ValueError):
+            logging.warning("Cannot parse mmrepquota line %s", line.strip())
+            continue
+        limits[key] = (soft, hard)
+
+    return limits
+
+
+class QuotaIndex(object):
+    """
+    The USR and FILESET block limits GPFS currently enforces, per filesystem.
+
+    A filesystem is listed (mmrepquota) the first time one of its limits is looked up. If the listing
+    fails, the filesystem has no known limits, so all changes are written. The index is thread safe.
+    """
+
+    def __init__(self, mmrepquota=MMREPQUOTA):
+        self.mmrepquota = mmrepquota
+        self._limits = {}  # device -> (type, id, fileset) -> (soft, hard) in KiB
+        self._lock = threading.RLock()
+
+    def limits(self, device):
+        """Return the limits on the device, see parse_mmrepquota."""
+        with self._lock:
+            if device not in self._limits:
+                logging.info("Listing the quota on %s", device)
+                (ec, output) = RunNoShell.run([self.mmrepquota, "-u", "-j", "-Y", device])
+                if ec != 0:
+                    logging.warning("Cannot list the quota on %s (exit code %s): %s", device, ec, output)
+                    self._limits[device] = {}
+                else:
+                    self._limits[device] = parse_mmrepquota(output.splitlines())
+            return self._limits[device]
+
+    def get(self, device, change):
+        """Return the (soft, hard) limits in KiB for the target of the change, None if unknown."""
+        return self.limits(device).get((change.typ, change.id, change.fileset))
+
+    def update(self, device, changes):
+        """Record that the given changes were applied."""
+        with self._lock:
+            limits = self.limits(device)
+            for change in changes:
+                limits[(change.typ, change.id, change.fileset)] = (change.soft // 1024, change.hard // 1024)
+
+
+def quota_stanza(device, change):
+    """
+    Return the mmsetquota stanza for the given change.
+
+    The limits are given in bytes and written in KiB.
+    """
+    lines = [
+        "%quota:",
+        "  device=%s" % (device,),
+        "  command=setquota",
+        "  type=%s" % (change.typ,),
+        "  id=%s" % (change.id,),
+    ]
+    if change.fileset is not None:
+        lines.append("  fileset=%s" % (change.fileset,))
+    lines.extend([
+        "  blockQuota=%dK" % (change.soft // 1024,),
+        "  blockLimit=%dK" % (change.hard // 1024,),
+    ])
+    return "\n".join(lines) + "\n"
+
+
+class QuotaWriter(object):
+    """
+    Collects the USR and FILESET quota changes per filesystem until they are flushed.
+
+    A later change for the same user (in the same fileset) or fileset replaces an earlier one.
+    Nothing is written when the gpfs instance is in dry run mode. The writer is thread safe.
+
+    With an index, changes to limits that are already in place are dropped. Per filesystem, drift
+    counts the changes that differ from the index and unchanged the dropped ones.
+    """
+
+    def __init__(self, gpfs, filesets, chunk_size=QUOTA_STANZA_CHUNK_SIZE, mmsetquota=MMSETQUOTA, index=None):
+        """
+        @type gpfs: GpfsOperations instance
+        @type filesets: FilesetInventory, to find the fileset holding a path
+        @param mmsetquota: path to the mmsetquota command
+        @type index: QuotaIndex with the current limits, or None to write all changes
+        """
+        self.gpfs = gpfs
+        self.filesets = filesets
+        self.chunk_size = chunk_size
+        self.mmsetquota = mmsetquota
+        self.index = index
+
+        self.drift = Counter()
+        self.unchanged = Counter()
+
+        self._pending = OrderedDict()  # device -> (type, id, fileset) -> QuotaChange
+        self._lock = threading.Lock()
+
+    def _add(self, device, change):
+        key = (change.typ, change.id, change.fileset)
+        if self.index is not None and self.index.get(device, change) == (change.soft // 1024, change.hard // 1024):
+            logging.debug("Quota for %s %s already in place on %s", change.typ, change.id, device)
+            with self._lock:
+                self.unchanged[device] += 1
+                # an earlier change for the same target is no longer wanted
+                self._pending.get(device, {}).pop(key, None)
+            return
+
+        with self._lock:
+            self.drift[device] += 1
+            self._pending.setdefault(device, OrderedDict())[key] = change
+
+    def set_user_quota(self, device, path, user, soft, hard, owner=None):
+        """
+        Queue the USR quota for the fileset holding the given path.
+
+        If the fileset is not known, the quota is set immediately.
+
+        @type user: the numerical user ID
+        @type soft, hard: limits in bytes
+        """
+        fileset = self.filesets.fileset_for_path(self.gpfs, device, path)
+        if fileset is None:
+            logging.warning("No fileset found on %s for %s, setting the quota for user %s directly", device, path, user)
+            self.gpfs.set_user_quota(soft, user, path, hard)
+            return
+
+        self._add(device, QuotaChange(USER_QUOTA, user, fileset, soft, hard, owner))
+
+    def set_fileset_quota(self, device, fileset_name, soft, hard, owner=None):
+        """
+        Queue the FILESET quota for the given fileset.
+
+        @type soft, hard: limits in bytes
+        """
+        self._add(device, QuotaChange(FILESET_QUOTA, fileset_name, None, soft, hard, owner))
+
+    def pending(self):
+        """Return the number of queued changes."""
+        with self._lock:
+            return sum([len(changes) for changes in self._pending.values()])
+
+    def _apply(self, device, changes):
+        """
+        Run mmsetquota -F for the given changes on the device.
+
+        @returns: True if the changes were applied
+        """
+        stanzas = "\n".join([quota_stanza(device, change) for change in changes])
+
+        if self.gpfs.dry_run:
+            logging.info("Dry run: not setting %d quota on %s", len(changes), device)
+            logging.debug("Dry run: quota stanzas for %s:\n%s", device, stanzas)
+            return True
+
+        (fd, stanza_file) = tempfile.mkstemp(prefix="mmsetquota_%s_" % (device,), suffix=".stanza")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(stanzas)
+            (ec, output) = RunNoShell.run([self.mmsetquota, "-F", stanza_file])
+        finally:
+            os.unlink(stanza_file)
+
+        if ec != 0:
+            logging.error("Setting %d quota on %s failed (exit code %s): %s", len(changes), device, ec, output)
+            return False
+
+        logging.info("Set %d quota on %s", len(changes), device)
+        return True
+
+    def flush(self):
+        """
+        Apply all queued changes, one mmsetquota call per chunk of changes on a filesystem.
+
+        @returns: list with the owners of the changes that could not be applied
+        """
+        with self._lock:
+            pending = self._pending
+            self._pending = OrderedDict()
+
+        failed = []
+        for (device, changes) in pending.items():
+            changes = list(changes.values())
+            for start in range(0, len(changes), self.chunk_size):
+                chunk = changes[start:start + self.chunk_size]
+                if not self._apply(device, chunk):
+                    failed.extend([change.owner for change in chunk])
+                elif self.index is not None and not self.gpfs.dry_run:
+                    self.index.update(device, chunk)
+
+        return failed
+
+
+class GracePeriods(object):
+    """
+    Sets the USR and FILESET grace periods at most once per target during a run.
+
+    The grace period applies to the fileset holding the given path (or to the path itself when that
+    fileset is not known), so setting it for every quota change on the same fileset only repeats the
+    same GPFS command. The settings that were made are remembered and identical ones are skipped.
+    The manager is thread safe.
+    """
+
+    def __init__(self, gpfs, filesets):
+        """
+        @type gpfs: GpfsOperations instance
+        @type filesets: FilesetInventory, to find the fileset holding a path
+        """
+        self.gpfs = gpfs
+        self.filesets = filesets
+        self.skipped = 0
+
+        self._grace = {}  # (quota type, device, fileset or path) -> grace time
+        self._lock = threading.Lock()
+
+    def _set(self, typ, device, path, grace, set_grace):
+        target = self.filesets.fileset_for_path(self.gpfs, device, path) or os.path.normpath(path)
+        key = (typ, device, target)
+        with self._lock:
+            if self._grace.get(key) == grace:
+                self.skipped += 1
+                return
+            set_grace(path, grace)
+            self._grace[key] = grace
+
+    def set_user_grace(self, device, path, grace):
+        """Set the USR grace time (in seconds) for the fileset holding the path, unless it was already set."""
+        self._set(USER_QUOTA, device, path, grace, self.gpfs.set_user_grace)
+
+    def set_fileset_grace(self, device, path, grace):
+        """Set the FILESET grace time (in seconds) for the fileset holding the path, unless it was already set."""
+        self._set(FILESET_QUOTA, device, path, grace, self.gpfs.set_fileset_grace)
@@ -0,0 +1,233 @@
+#
+# Copyright 2018-2018 Ghent University
+#
+# This file is part of vsc-administration,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-administration
+#
+# All rights reserved.
+#
+"""
+Synthetic-scale benchmark for the Slurm sync planner.
+
+Generates an account page VO set and a matching sacctmgr association listing of a given size, runs
+the stages of the sync on them and reports the wall time, peak memory and command counts per stage
+as JSON, e.g.,
+
+    python -m vsc.administration.slurm.benchmark --users 100000 --vos 10000 --clusters 8
+"""
+import json
+import random
+import resource
+import time
+
+from collections import namedtuple
+
+from vsc.administration.slurm.sync import SACCTMGR_ASSOCIATION_FORMAT, SyncTypes, SlurmAssociationIndex
+from vsc.administration.slurm.sync import parse_slurm_acct_table, parse_slurm_association_dump
+from vsc.administration.slurm.sync import slurm_institute_accounts, slurm_vo_accounts, slurm_user_accounts
+from vsc.administration.slurm.sync import coalesce_commands
+from vsc.utils.generaloption import simple_option
+
+SyntheticVo = namedtuple("SyntheticVo", ["vsc_id", "institute", "members"])
+
+SACCTMGR_USER_HEADER = "User|Def Acct|Admin|Cluster|Account|Partition|Share|MaxJobs|MaxNodes|MaxCPUs|MaxSubmit|" \
+                       "MaxWall|MaxCPUMins|QOS|Def QOS"
+
+
+def generate_account_page_vos(users, vos, rng):
+    """Generate VOs with the given total number of members, every user belongs to a single VO.
+
+    @returns: tuple (list of SyntheticVo, set of active accounts)
+    """
+    members = dict([("gvo%05d" % (100 + v), []) for v in range(vos)])
+    vo_ids = sorted(members)
+    for u in range(users):
+        members[rng.choice(vo_ids)].append("vsc4%05d" % u)
+
+    account_page_vos = [SyntheticVo(vsc_id=vo_id, institute={"site": "gent"}, members=members[vo_id])
+                        for vo_id in vo_ids]
+    active_accounts = set(["vsc4%05d" % u for u in range(users) if rng.random() > 0.01])
+
+    return (account_page_vos, active_accounts)
+
+
+def generate_slurm_associations(account_page_vos, clusters, drift, rng):
+    """Generate the user and account associations in Slurm for the given VOs.
+
+    A fraction (drift) of the users is missing from Slurm or still associated with another VO, so the
+    planner has work to do.
+
+    @returns: list of (cluster, account, user, parent) tuples
+    """
+    vo_ids = [vo.vsc_id for vo in account_page_vos]
+    associations = []
+    for cluster in clusters:
+        associations.append((cluster, "gent", "", "root"))
+        for vo in account_page_vos:
+            associations.append((cluster, vo.vsc_id, "", "gent"))
+            for member in vo.members:
+                r = rng.random()
+                if r < drift / 2:
+                    continue  # new user
+                elif r < drift:
+                    associations.append((cluster, rng.choice(vo_ids), member, ""))  # moved user
+                else:
+                    associations.append((cluster, vo.vsc_id, member, ""))
+    return associations
+
+
+def association_dump(associations):
+    """Yield the lines of a sacctmgr association listing."""
+    yield "|".join(["Cluster", "Account", "User", "Par Name", "Share"])
+    for (cluster, account, user, parent) in associations:
+        yield "|".join([cluster, account, user, parent, "1"])
+
+
+def default_accounts(associations):
+    """Return the default accounts as given by get_slurm_default_accounts, every user has a single association."""
+    return dict([((cluster, user), account) for (cluster, account, user, _) in associations if user])
+
+
+def user_dump(associations):
+    """Yield the lines of a sacctmgr -s list users listing."""
+    yield SACCTMGR_USER_HEADER
+    for (cluster, account, user, _) in associations:
+        if user:
+            yield "|".join([user, account, "None", cluster, account, "", "1", "", "", "", "", "", "", "normal", ""])
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size (VmHWM) of the process to its current size.
+
+    This is only possible on Linux (3.11 or newer).
+
+    @returns: True if the peak was reset
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def peak_rss_kb():
+    """Return the peak resident set size (VmHWM) of the process in KiB, None if it is not available."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return None
+
+
+class Stages(object):
+    """Keep the wall time and peak memory for each stage.
+
+    The peak resident set size is reset before each stage, so stage_peak_rss_kb is the peak reached during
+    that stage (including the memory still held from earlier stages). When the peak cannot be reset, only
+    the peak of the whole process so far is reported, as process_peak_rss_kb.
+    """
+
+    def __init__(self):
+        self.results = []
+
+    def run(self, name, f, *args, **kwargs):
+        reset = reset_peak_rss()
+        start = time.time()
+        result = f(*args, **kwargs)
+        stage = {
+            "stage": name,
+            "wall_time": time.time() - start,
+        }
+        peak = peak_rss_kb() if reset else None
+        if peak is not None:
+            stage["stage_peak_rss_kb"] = peak
+        else:
+            stage["process_peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.results.append(stage)
+        return result
+
+
+def run_benchmark(users, vos, clusters, drift=0.05, seed=42):
+    """Run the sync planner on synthetic data of the given size.
+
+    @param users: number of accounts
+    @param vos: number of VOs
+    @param clusters: number of clusters
+    @param drift: fraction of the users that are not in their correct Slurm account
+    @param seed: seed for the random generator, so runs are reproducible
+
+    @returns: dict with the parameters, the per stage results and the command counts
+    """
+    rng = random.Random(seed)
+    cluster_names = ["cluster%02d" % c for c in range(clusters)]
+    stages = Stages()
+
+    (account_page_vos, active_accounts) = stages.run("generate", generate_account_page_vos, users, vos, rng)
+    associations = stages.run("generate_slurm", generate_slurm_associations,
+                              account_page_vos, cluster_names, drift, rng)
+
+    stages.run("parse_slurm_acct_table", parse_slurm_acct_table, user_dump(associations), SyncTypes.users)
+    (accounts, slurm_users) = stages.run("parse_slurm_association_dump", parse_slurm_association_dump,
+                                         association_dump(associations), default_accounts(associations))
+    del associations
+
+    index = stages.run("index", SlurmAssociationIndex, accounts, slurm_users)
+    vo_members = dict([(vo.vsc_id, (set(vo.members), vo)) for vo in account_page_vos])
+
+    institute_commands = stages.run("slurm_institute_accounts", slurm_institute_accounts, index, cluster_names)
+    vo_commands = stages.run("slurm_vo_accounts", slurm_vo_accounts, account_page_vos, index, cluster_names)
+    user_commands = stages.run("slurm_user_accounts", slurm_user_accounts,
+                               vo_members, active_accounts, index, cluster_names)
+    coalesced = stages.run("coalesce_commands", coalesce_commands,
+                           institute_commands + vo_commands + user_commands)
+
+    return {
+        "parameters": {
+            "users": users,
+            "vos": vos,
+            "clusters": clusters,
+            "drift": drift,
+            "seed": seed,
+            "association_format": SACCTMGR_ASSOCIATION_FORMAT,
+        },
+        "stages": stages.results,
+        "commands": {
+            "institute": len(institute_commands),
+            "vo": len(vo_commands),
+            "user": len(user_commands),
+            "coalesced": len(coalesced),
+        },
+    }
+
+
+def main():
+    options = {
+        "users": ("Number of accounts", int, "store", 100000),
+        "vos": ("Number of VOs", int, "store", 10000),
+        "clusters": ("Number of clusters", int, "store", 8),
+        "drift": ("Fraction of users that are not in their correct Slurm account", float, "store", 0.05),
+        "seed": ("Seed for the random generator", int, "store", 42),
+    }
+    opts = simple_option(options)
+
+    print(json.dumps(run_benchmark(
+        opts.options.users,
+        opts.options.vos,
+        opts.options.clusters,
+        opts.options.drift,
+        opts.options.seed,
+    ), indent=4, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
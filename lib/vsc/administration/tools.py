@@ -23,7 +23,14 @@ Original Perl code by Stijn De Weirdt
 import logging
 import os
 import stat
+import threading
 
+from multiprocessing.pool import ThreadPool
+
+from vsc.administration.quota import GracePeriods, QuotaIndex, QuotaWriter
+from vsc.config.base import VSC, VscStorage
+from vsc.filesystem.gpfs import GpfsOperations
+from vsc.filesystem.posix import PosixOperations
 from vsc.utils import fancylogger
 from vsc.utils.mail import VscMail
 
@@ -32,6 +39,11 @@ TIER1_GRACE_GROUP_SUFFIX = "t1_mukgraceusers"
 TIER1_HELPDESK_ADDRESS = "tier1@ugent.be"
 UGENT_SMTP_ADDRESS = "smtp.ugent.be"
 
+# number of concurrent requests to the account page REST API
+REST_WORKERS = 8
+# number of users that are provisioned concurrently on a filesystem
+FS_WORKERS = 4
+
 REINSTATEMENT_MESSAGE = """
 Dear %(gecos)s,
 
@@ -76,3 +88,199 @@ def create_stat_directory(path, permissions, uid, gid, posix, override_permissio
         logging.debug("Path %s already exists with correct ownership" % (path,))
 
     return created
+
+
+def resolve_concurrently(entities, attributes, workers=REST_WORKERS):
+    """
+    Resolve the given REST backed attributes of the entities in a pool of worker threads.
+
+    The entities cache these attributes, so the (sequential) processing afterwards no longer waits
+    on the account page. A failure is only logged here: the attribute is fetched again, and the error
+    raised, when it is used during the processing.
+
+    @type entities: list of objects with cached properties, e.g., VscTier2AccountpageUser instances
+    @type attributes: list of attribute names, resolved in this order for each entity
+    """
+    if workers <= 1 or len(entities) <= 1:
+        return
+
+    def resolve(entity):
+        for attribute in attributes:
+            try:
+                getattr(entity, attribute)
+            except Exception as err:
+                logging.debug("Could not resolve %s for %s: %s", attribute, entity, err)
+                return
+
+    pool = ThreadPool(min(workers, len(entities)))
+    try:
+        pool.map(resolve, entities)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def map_grouped(func, entities, group, workers=FS_WORKERS):
+    """
+    Apply func to all entities, with at most workers threads.
+
+    The first entity of each group is handled before all others, one at a time, so the work a group
+    shares (e.g., creating its grouping fileset) is done once and never concurrently. The remaining
+    entities are handled in a pool of worker threads afterwards. Entities without a group (None) are
+    handled one at a time as well, and so are the remaining entities of a group whose first entity
+    failed (i.e., gave a false result), as the shared work is then tried again by each of them.
+
+    @type group: function yielding the (hashable) group of an entity, None if it cannot be determined
+    @returns: list with the results, in the order of the entities
+    """
+    if workers <= 1 or len(entities) <= 1:
+        return [func(entity) for entity in entities]
+
+    (first, rest) = ([], [])
+    seen = {}  # group -> index of its first entity
+    for (index, entity) in enumerate(entities):
+        key = group(entity)
+        if key is None:
+            first.append(index)
+        elif key in seen:
+            rest.append((index, key))
+        else:
+            seen[key] = index
+            first.append(index)
+
+    results = [None] * len(entities)
+    for index in first:
+        results[index] = func(entities[index])
+
+    failed = set([key for (key, index) in seen.items() if not results[index]])
+    for (index, key) in rest:
+        if key in failed:
+            results[index] = func(entities[index])
+
+    concurrent = [index for (index, key) in rest if key not in failed]
+    if concurrent:
+        pool = ThreadPool(min(workers, len(concurrent)))
+        try:
+            for (index, result) in zip(concurrent, pool.map(lambda index: func(entities[index]), concurrent)):
+                results[index] = result
+        finally:
+            pool.close()
+            pool.join()
+
+    return results
+
+
+class FilesetInventory(object):
+    """
+    Process wide inventory of the GPFS filesets.
+
+    The filesets of a filesystem are listed (mmlsfileset) once, the first time a fileset on that
+    filesystem is looked up. Filesets created through the inventory are added to it, so the listing
+    never has to be refreshed during a run. The inventory is shared by users and VOs and is thread safe.
+    """
+
+    def __init__(self):
+        self._filesets = {}  # filesystem name -> fileset name -> fileset info
+        self._lock = threading.RLock()
+
+    def filesets(self, gpfs, filesystem_name):
+        """Return a dict mapping the fileset names on the given filesystem on their information."""
+        with self._lock:
+            if filesystem_name not in self._filesets:
+                logging.info("Listing the filesets on %s", filesystem_name)
+                listing = gpfs.list_filesets(devices=[filesystem_name], update=True) or {}
+                self._filesets[filesystem_name] = dict([
+                    (info['filesetName'], info) for info in listing.get(filesystem_name, {}).values()
+                ])
+            return self._filesets[filesystem_name]
+
+    def get_fileset_info(self, gpfs, filesystem_name, fileset_name):
+        """Return the information for the given fileset, None if it does not exist."""
+        return self.filesets(gpfs, filesystem_name).get(fileset_name)
+
+    def fileset_for_path(self, gpfs, filesystem_name, path):
+        """Return the name of the fileset holding the given path, i.e., with the longest matching link path."""
+        path = os.path.normpath(path)
+        found = (None, -1)
+        for (name, info) in self.filesets(gpfs, filesystem_name).items():
+            link_path = info.get('path')
+            if not link_path:
+                continue
+            link_path = os.path.normpath(link_path)
+            if (path == link_path or path.startswith(link_path.rstrip(os.sep) + os.sep)) and len(link_path) > found[1]:
+                found = (name, len(link_path))
+        return found[0]
+
+    def make_fileset(self, gpfs, filesystem_name, path, fileset_name, parent_fileset_name=None):
+        """
+        Create the fileset, and the parent directory of its link path, and add it to the inventory.
+
+        The check whether the fileset exists is made while holding the lock, so concurrent callers
+        create a fileset only once.
+
+        @returns: True if the fileset was created, False if it already existed
+        """
+        with self._lock:
+            if self.get_fileset_info(gpfs, filesystem_name, fileset_name):
+                return False
+            gpfs.make_dir(os.path.dirname(path))
+            if parent_fileset_name is None:
+                gpfs.make_fileset(path, fileset_name)
+            else:
+                gpfs.make_fileset(path, fileset_name, parent_fileset_name)
+            self.filesets(gpfs, filesystem_name)[fileset_name] = {
+                'filesetName': fileset_name,
+                'path': path,
+            }
+            return True
+
+    def invalidate(self, filesystem_name=None):
+        """Forget the filesets of the given filesystem, or of all filesystems, so they are listed again."""
+        with self._lock:
+            if filesystem_name is None:
+                self._filesets.clear()
+            else:
+                self._filesets.pop(filesystem_name, None)
+
+
+fileset_inventory = FilesetInventory()
+
+
+class ProvisioningContext(object):
+    """
+    What the users and VOs of a single run share to deploy their directories, filesets and quota.
+
+    - storage: the VscStorage configuration
+    - vsc: the VSC settings
+    - gpfs, posix: the GpfsOperations and PosixOperations handles
+    - filesets: the FilesetInventory
+    - quota_writer: the QuotaWriter collecting the quota changes, to be flushed at the end of a run;
+      by default it only writes the limits that differ from the current mmrepquota listing
+    - grace_periods: the GracePeriods, so each grace time is set once per run
+    - dry_run: set here, it is passed on to the gpfs and posix handles
+
+    Building these once per run, instead of once per user or VO, keeps creating an entity cheap.
+    """
+
+    def __init__(self, storage=None, dry_run=False, gpfs=None, posix=None, filesets=None, quota_writer=None,
+                 grace_periods=None):
+        if not storage:
+            self.storage = VscStorage()
+        else:
+            self.storage = storage
+
+        self.vsc = VSC()
+        self.gpfs = gpfs or GpfsOperations()
+        self.posix = posix or PosixOperations()
+        self.filesets = filesets or fileset_inventory
+        self.quota_writer = quota_writer or QuotaWriter(self.gpfs, self.filesets, index=QuotaIndex())
+        self.grace_periods = grace_periods or GracePeriods(self.gpfs, self.filesets)
+        self.dry_run = dry_run
+
+    def __setattr__(self, name, value):
+        """Pass the dry_run setting on to the gpfs and posix handles."""
+        if name == 'dry_run':
+            self.gpfs.dry_run = value
+            self.posix.dry_run = value
+
+        super(ProvisioningContext, self).__setattr__(name, value)
@@ -22,25 +22,27 @@ This file contains the utilities for dealing with users on the VSC.
 
 import logging
 import os
+import threading
+import time
 
+from collections import OrderedDict
 from urllib2 import HTTPError
 
 from vsc.utils import fancylogger
 from vsc.accountpage.wrappers import mkVscAccountPubkey, mkVscHomeOnScratch
 from vsc.accountpage.wrappers import mkVscAccount, mkUserGroup
 from vsc.accountpage.wrappers import mkGroup, mkVscUserSizeQuota
-from vsc.administration.tools import create_stat_directory
+from vsc.administration.tools import create_stat_directory, fileset_inventory, resolve_concurrently, REST_WORKERS
+from vsc.administration.tools import map_grouped, ProvisioningContext, FS_WORKERS
 from vsc.config.base import VSC, VscStorage, VSC_DATA, VSC_HOME, GENT_PRODUCTION_SCRATCH, GENT
 from vsc.config.base import NEW, MODIFIED, MODIFY, ACTIVE
 from vsc.filesystem.gpfs import GpfsOperations
 from vsc.filesystem.posix import PosixOperations
 
 
-# Cache for user instances
-_users_cache = {
-    'VscAccountPageUser': {},
-    'VscTier2AccountpageUser': {},
-}
+USER_CACHE_SIZE = 50000  # number of users
+USER_CACHE_TTL = 60 * 60  # seconds
+PREFETCH_THRESHOLD = 100  # number of users
 
 
 log = fancylogger.getLogger(__name__)
@@ -50,6 +52,102 @@ class UserStatusUpdateError(Exception):
     pass
 
 
+class UserCache(object):
+    """
+    Cache for the account page information of user instances, per user class and user id.
+
+    The cache holds at most max_size users, the least recently used user is dropped first. An entry
+    that is older than ttl seconds is started afresh, so the information is fetched again. Users can
+    be invalidated explicitly, e.g., when they show up in the modified listings of the account page.
+
+    The cache is thread safe.
+    """
+    def __init__(self, max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # (class name, user id) -> (creation time, cache dict)
+        self._lock = threading.RLock()
+        self._stats = dict.fromkeys(['hits', 'misses', 'expired', 'evicted', 'invalidated'], 0)
+
+    def entry(self, class_name, user_id, record_stats=True):
+        """
+        Return the cache dict for the given user.
+
+        A new (empty) dict is returned and kept if the user is not cached or the entry expired.
+        """
+        key = (class_name, user_id)
+        now = time.time()
+        with self._lock:
+            item = self._entries.pop(key, None)
+            if item is not None and now - item[0] > self.ttl:
+                if record_stats:
+                    self._stats['expired'] += 1
+                item = None
+
+            if record_stats:
+                self._stats['hits' if item is not None else 'misses'] += 1
+            if item is None:
+                item = (now, {})
+
+            self._entries[key] = item  # most recently used last
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats['evicted'] += 1
+
+            return item[1]
+
+    def peek(self, class_name, user_id):
+        """Return the cache dict for the given user if it is cached and has not expired, None otherwise."""
+        with self._lock:
+            item = self._entries.get((class_name, user_id))
+            if item is None or time.time() - item[0] > self.ttl:
+                return None
+            return item[1]
+
+    def invalidate(self, user_ids, class_name=None):
+        """Drop the given users from the cache, for all user classes unless a class name is given."""
+        user_ids = set(user_ids)
+        with self._lock:
+            for key in [k for k in self._entries if k[1] in user_ids and class_name in (None, k[0])]:
+                del self._entries[key]
+                self._stats['invalidated'] += 1
+
+    def invalidate_modified(self, client, timestamp, storage_names=None):
+        """
+        Drop the users whose account or quota changed in the account page since the given timestamp.
+
+        @param timestamp: unix timestamp
+        @param storage_names: storages for which quota changes are taken into account
+
+        @returns: set of the invalidated user ids
+        """
+        user_ids = set([a['vsc_id'] for a in client.account.modified[timestamp].get()[1]])
+        for storage_name in storage_names or []:
+            user_ids |= set([q['user'] for q in client.quota.user.storage[storage_name].modified[timestamp].get()[1]])
+
+        self.invalidate(user_ids)
+        return user_ids
+
+    def clear(self):
+        """Drop all users from the cache."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return a dict with the size and the hit, miss, expiry, eviction and invalidation counts."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        return stats
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Cache for user instances
+_users_cache = UserCache()
+
+
 class VscAccountPageUser(object):
     """
     A user who gets his own information from the accountpage through the REST API.
@@ -67,18 +165,18 @@ class VscAccountPageUser(object):
 
         # init global cache
         if use_user_cache:
-            self._cache = _users_cache[self.__class__.__name__].setdefault(user_id, {})
+            self._cache = _users_cache.entry(self.__class__.__name__, user_id)
         else:
             self._cache = {}
 
-        if not self._cache:
-            self._init_cache(pubkeys=pubkeys, account=account)
+        # the cache may already be (partially) filled, e.g., by prefetch_users
+        self._init_cache(pubkeys=pubkeys, account=account)
 
     def _init_cache(self, **kwargs):
-        self._cache['pubkeys'] = kwargs.get('pubkeys', None)
-        self._cache['account'] = kwargs.get('account', None)
-        self._cache['usergroup'] = None
-        self._cache['home_on_scratch'] = None
+        self._cache.setdefault('pubkeys', kwargs.get('pubkeys', None))
+        self._cache.setdefault('account', kwargs.get('account', None))
+        self._cache.setdefault('usergroup', None)
+        self._cache.setdefault('home_on_scratch', None)
 
     @property
     def account(self):
@@ -128,28 +226,43 @@ class VscTier2AccountpageUser(VscAccountPageUser):
     to retrieve its information.
     """
     def __init__(self, user_id, storage=None, pickle_storage='VSC_SCRATCH_KYUKON', rest_client=None,
-                 account=None, pubkeys=None, host_institute=None, use_user_cache=False):
+                 account=None, pubkeys=None, host_institute=None, use_user_cache=False, context=None):
         """
         Initialisation.
         @type vsc_user_id: string representing the user's VSC ID (vsc[0-9]{5})
+        @type context: ProvisioningContext shared with the other users and VOs of the run; without one,
+                       the user sets up its own storage configuration and GPFS and POSIX handles.
         """
         super(VscTier2AccountpageUser, self).__init__(user_id, rest_client, account=account,
                                                       pubkeys=pubkeys, use_user_cache=use_user_cache)
 
         self.pickle_storage = pickle_storage
-        if not storage:
-            self.storage = VscStorage()
+        if context is None:
+            if not storage:
+                self.storage = VscStorage()
+            else:
+                self.storage = storage
+
+            self.vsc = VSC()
+            self.gpfs = GpfsOperations()  # Only used when needed
+            self.posix = PosixOperations()
+            self.filesets = fileset_inventory
+            self.quota_writer = None
+            self.grace_periods = None
         else:
-            self.storage = storage
-
-        self.vsc = VSC()
-        self.gpfs = GpfsOperations()  # Only used when needed
-        self.posix = PosixOperations()
+            self.storage = storage or context.storage
+            self.vsc = context.vsc
+            self.gpfs = context.gpfs
+            self.posix = context.posix
+            self.filesets = context.filesets
+            self.quota_writer = context.quota_writer
+            self.grace_periods = context.grace_periods
         self.host_institute = host_institute
 
     def _init_cache(self, **kwargs):
         super(VscTier2AccountpageUser, self)._init_cache(**kwargs)
-        self._cache['quota'] = {}
+        self._cache.setdefault('quota', {})
+        self._cache.setdefault('all_quota', None)
 
     @property
     def user_home_quota(self):
@@ -184,7 +297,10 @@ class VscTier2AccountpageUser(VscAccountPageUser):
     def _init_quota_cache(self):
         if self.host_institute is None:
             logging.warn("_init_quota_cache with host_institute None")
-        all_quota = [mkVscUserSizeQuota(q) for q in self.rest_client.account[self.user_id].quota.get()[1]]
+        if self._cache['all_quota'] is None:
+            quota = self.rest_client.account[self.user_id].quota.get()[1]
+            self._cache['all_quota'] = [mkVscUserSizeQuota(q) for q in quota]
+        all_quota = self._cache['all_quota']
         # we no longer set defaults, since we do not want to accidentally revert people to some default
         # that is lower than their actual quota if the accountpage goes down in between retrieving the users
         # and fetching the quota
@@ -229,14 +345,10 @@ class VscTier2AccountpageUser(VscAccountPageUser):
 
         - creates the fileset if it does not already exist
         """
-        self.gpfs.list_filesets()
         logging.info("Trying to create the grouping fileset %s with link path %s", fileset_name, path)
 
-        if not self.gpfs.get_fileset_info(filesystem_name, fileset_name):
-            logging.info("Creating new fileset on %s with name %s and path %s", filesystem_name, fileset_name, path)
-            base_dir_hierarchy = os.path.dirname(path)
-            self.gpfs.make_dir(base_dir_hierarchy)
-            self.gpfs.make_fileset(path, fileset_name)
+        if self.filesets.make_fileset(self.gpfs, filesystem_name, path, fileset_name):
+            logging.info("Created new fileset on %s with name %s and path %s", filesystem_name, fileset_name, path)
         else:
             logging.info("Fileset %s already exists for user group of %s ... not creating again.",
                          fileset_name, self.account.vsc_id)
@@ -333,6 +445,9 @@ class VscTier2AccountpageUser(VscAccountPageUser):
     def _set_quota(self, storage_name, path, hard):
         """Set the given quota on the target path.
 
+        With a quota writer (from the ProvisioningContext), the quota is only queued there, and the
+        grace time is only set if it was not yet set for the fileset during this run.
+
         @type path: path into a GPFS mount
         @type hard: hard limit
         """
@@ -346,8 +461,16 @@ class VscTier2AccountpageUser(VscAccountPageUser):
         logging.info("Setting quota for %s on %s to %d", storage_name, path, quota)
 
         # LDAP information is expressed in KiB, GPFS wants bytes.
-        self.gpfs.set_user_quota(soft, int(self.account.vsc_id_number), path, quota)
-        self.gpfs.set_user_grace(path, self.vsc.user_storage_grace_time)  # 7 days
+        if self.quota_writer is None:
+            self.gpfs.set_user_quota(soft, int(self.account.vsc_id_number), path, quota)
+        else:
+            self.quota_writer.set_user_quota(self.storage[storage_name].filesystem, path,
+                                             int(self.account.vsc_id_number), soft, quota, owner=self.user_id)
+        if self.grace_periods is None:
+            self.gpfs.set_user_grace(path, self.vsc.user_storage_grace_time)  # 7 days
+        else:
+            self.grace_periods.set_user_grace(self.storage[storage_name].filesystem, path,
+                                              self.vsc.user_storage_grace_time)
 
     def set_home_quota(self):
         """Set USR quota on the home FS in the user fileset."""
@@ -441,39 +564,103 @@ def update_user_status(user, client):
                                         (user.user_id, account.status))
 
 
-def process_users_quota(options, user_quota, storage_name, client, host_institute=None, use_user_cache=True):
+def prefetch_users(account_ids, client, accounts=None, threshold=PREFETCH_THRESHOLD):
+    """
+    Fill the user cache with the account information of the given accounts.
+
+    The account records can be passed in, e.g., from the modified accounts listing the caller already has.
+    Otherwise, the complete account listing is fetched, but only when at least threshold accounts are not
+    cached yet; for fewer accounts a request per user is cheaper. The usergroups, public keys and quota
+    are fetched per user when needed.
+
+    @param accounts: list of account records (dicts) as returned by the account page REST API
+    @param threshold: minimal number of uncached accounts for which the complete listing is fetched
+
+    @returns: list of the account ids for which the cache was filled
+    """
+    class_name = 'VscTier2AccountpageUser'
+    account_ids = set([vsc_id for vsc_id in account_ids
+                       if not (_users_cache.peek(class_name, vsc_id) or {}).get('account')])
+    if not account_ids:
+        return []
+
+    if accounts is None:
+        if len(account_ids) < threshold:
+            return []
+        try:
+            accounts = client.account.get()[1]
+        except Exception as err:
+            log.warning("Could not prefetch the accounts (%s), falling back to a request per user", err)
+            return []
+
+    accounts = dict([(a['vsc_id'], mkVscAccount(a)) for a in accounts if a['vsc_id'] in account_ids])
+    log.info("Prefetched %d of %d accounts", len(accounts), len(account_ids))
+
+    for (vsc_id, account) in accounts.items():
+        _users_cache.entry(class_name, vsc_id, record_stats=False)['account'] = account
+
+    return sorted(accounts)
+
+
+def process_users_quota(options, user_quota, storage_name, client, host_institute=None, use_user_cache=True,
+                        rest_workers=REST_WORKERS, context=None):
     """
     Process the users' quota for the given storage.
+
+    @param rest_workers: number of concurrent requests to the account page
+    @param context: ProvisioningContext shared by all users, a new one is made if not given
+
+    The quota are queued in the quota writer of the context and applied in bulk at the end.
     """
     error_quota = []
     ok_quota = []
 
-    for quota in user_quota:
-        user = VscTier2AccountpageUser(quota.user,
-                                       rest_client=client,
-                                       host_institute=host_institute,
-                                       use_user_cache=use_user_cache)
-        user.dry_run = options.dry_run
-
-        try:
-            if storage_name in ['VSC_HOME']:
-                user.set_home_quota()
+    if use_user_cache:
+        prefetch_users([quota.user for quota in user_quota], client)
 
-            if storage_name in ['VSC_DATA']:
-                user.set_data_quota()
+    if context is None:
+        context = ProvisioningContext(dry_run=options.dry_run)
 
-            if storage_name in GENT_PRODUCTION_SCRATCH:
-                user.set_scratch_quota(storage_name)
+    users = [VscTier2AccountpageUser(quota.user,
+                                     rest_client=client,
+                                     host_institute=host_institute,
+                                     use_user_cache=use_user_cache,
+                                     context=context)
+             for quota in user_quota]
+    # the quota properties need the account as well
+    resolve_concurrently(users, ['account', 'user_home_quota'], rest_workers)
 
-            ok_quota.append(quota)
-        except Exception:
-            log.exception("Cannot process user %s" % (user.user_id))
-            error_quota.append(quota)
+    try:
+        for (quota, user) in zip(user_quota, users):
+            user.dry_run = options.dry_run
+
+            try:
+                if storage_name in ['VSC_HOME']:
+                    user.set_home_quota()
+
+                if storage_name in ['VSC_DATA']:
+                    user.set_data_quota()
+
+                if storage_name in GENT_PRODUCTION_SCRATCH:
+                    user.set_scratch_quota(storage_name)
+
+                ok_quota.append(quota)
+            except Exception:
+                log.exception("Cannot process user %s" % (user.user_id))
+                error_quota.append(quota)
+    finally:
+        # flush even when a user failed halfway, so no quota of these users stay queued in a shared context
+        failed = set(context.quota_writer.flush())
+    if failed:
+        log.error("Could not set the quota for users %s on %s", sorted(failed), storage_name)
+        error_quota.extend([quota for quota in ok_quota if quota.user in failed])
+        ok_quota = [quota for quota in ok_quota if quota.user not in failed]
 
     return (ok_quota, error_quota)
 
 
-def process_users(options, account_ids, storage_name, client, host_institute=None, use_user_cache=True):
+def process_users(options, account_ids, storage_name, client, host_institute=None, use_user_cache=True,
+                  rest_workers=REST_WORKERS, context=None, fs_workers=FS_WORKERS, accounts=None):
     """
     Process the users.
 
@@ -487,15 +674,41 @@ def process_users(options, account_ids, storage_name, client, host_institute=Non
             - create the grouping fileset if needed
             - create the user scratch directory
 
+    The account page information is fetched concurrently (with rest_workers threads) up front.
+    The first user of each grouping fileset is then deployed on its own, so the fileset is created
+    once, after which the other users are deployed concurrently (with fs_workers threads).
+    All users share the given ProvisioningContext.
+
+    @param accounts: account records the caller already has for (some of) the users, see prefetch_users
     """
     error_users = []
     ok_users = []
 
-    for vsc_id in sorted(account_ids):
-        user = VscTier2AccountpageUser(vsc_id,
-                                       rest_client=client,
-                                       host_institute=host_institute,
-                                       use_user_cache=use_user_cache)
+    if use_user_cache:
+        prefetch_users(account_ids, client, accounts)
+
+    if context is None:
+        context = ProvisioningContext(dry_run=options.dry_run)
+
+    users = [VscTier2AccountpageUser(vsc_id,
+                                     rest_client=client,
+                                     host_institute=host_institute,
+                                     use_user_cache=use_user_cache,
+                                     context=context)
+             for vsc_id in sorted(account_ids)]
+    if storage_name in ['VSC_HOME']:
+        resolve_concurrently(users, ['account', 'usergroup', 'pubkeys'], rest_workers)
+    else:
+        resolve_concurrently(users, ['account', 'usergroup'], rest_workers)
+
+    def grouping_fileset(user):
+        # users for which this fails are deployed one at a time
+        try:
+            return user._get_grouping_path(storage_name)[1]
+        except Exception:
+            return None
+
+    def deploy(user):
         user.dry_run = options.dry_run
 
         try:
@@ -510,9 +723,17 @@ def process_users(options, account_ids, storage_name, client, host_institute=Non
             if storage_name in GENT_PRODUCTION_SCRATCH:
                 user.create_scratch_dir(storage_name)
 
-            ok_users.append(user)
+            return True
         except Exception:
             log.exception("Cannot process user %s" % (user.user_id))
+            return False
+
+    for (user, deployed) in zip(users, map_grouped(deploy, users, grouping_fileset, fs_workers)):
+        if deployed:
+            ok_users.append(user)
+        else:
             error_users.append(user)
 
+    log.info("User cache statistics: %s", _users_cache.stats())
+
     return (ok_users, error_users)
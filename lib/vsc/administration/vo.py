@@ -29,7 +29,8 @@ import pwd
 from urllib2 import HTTPError
 
 from vsc.accountpage.wrappers import mkVo, mkVscVoSizeQuota, mkVscAccount, mkVscAutogroup
-from vsc.administration.tools import create_stat_directory
+from vsc.administration.tools import create_stat_directory, fileset_inventory, resolve_concurrently, REST_WORKERS
+from vsc.administration.tools import ProvisioningContext
 from vsc.administration.user import VscTier2AccountpageUser, UserStatusUpdateError
 from vsc.config.base import VSC, VscStorage, VSC_HOME, VSC_DATA, VSC_DATA_SHARED, GENT_PRODUCTION_SCRATCH
 from vsc.config.base import NEW, MODIFIED, MODIFY, ACTIVE, GENT, DATA_KEY, SCRATCH_KEY
@@ -85,20 +86,36 @@ class VscTier2AccountpageVo(VscAccountPageVo):
     A VO is a special kind of group, identified mainly by its name.
     """
 
-    def __init__(self, vo_id, storage=None, rest_client=None):
-        """Initialise"""
+    def __init__(self, vo_id, storage=None, rest_client=None, context=None):
+        """Initialise
+
+        @type context: ProvisioningContext shared with the other VOs and users of the run; without one,
+                       the VO sets up its own storage configuration and GPFS and POSIX handles.
+        """
         super(VscTier2AccountpageVo, self).__init__(vo_id, rest_client)
 
         self.vo_id = vo_id
-        self.vsc = VSC()
+        if context is None:
+            self.vsc = VSC()
 
-        if not storage:
-            self.storage = VscStorage()
-        else:
-            self.storage = storage
+            if not storage:
+                self.storage = VscStorage()
+            else:
+                self.storage = storage
 
-        self.gpfs = GpfsOperations()
-        self.posix = PosixOperations()
+            self.gpfs = GpfsOperations()
+            self.posix = PosixOperations()
+            self.filesets = fileset_inventory
+            self.quota_writer = None
+            self.grace_periods = None
+        else:
+            self.vsc = context.vsc
+            self.storage = storage or context.storage
+            self.gpfs = context.gpfs
+            self.posix = context.posix
+            self.filesets = context.filesets
+            self.quota_writer = context.quota_writer
+            self.grace_periods = context.grace_periods
 
         self._vo_data_quota_cache = None
         self._vo_data_shared_quota_cache = None
@@ -213,7 +230,6 @@ class VscTier2AccountpageVo(VscAccountPageVo):
 
         The parent_fileset is used to support older (< 3.5.x) GPFS setups still present in our system
         """
-        self.gpfs.list_filesets()
         if not fileset_name:
             fileset_name = self.vo.vsc_id
 
@@ -222,17 +238,10 @@ class VscTier2AccountpageVo(VscAccountPageVo):
         else:
             fileset_group_owner_id = self.vo.vsc_id_number
 
-        if not self.gpfs.get_fileset_info(filesystem_name, fileset_name):
-            logging.info("Creating new fileset on %s with name %s and path %s" %
+        # HACK to support versions older than 3.5 in our setup
+        if self.filesets.make_fileset(self.gpfs, filesystem_name, path, fileset_name, parent_fileset):
+            logging.info("Created new fileset on %s with name %s and path %s" %
                          (filesystem_name, fileset_name, path))
-            base_dir_hierarchy = os.path.dirname(path)
-            self.gpfs.make_dir(base_dir_hierarchy)
-
-            # HACK to support versions older than 3.5 in our setup
-            if parent_fileset is None:
-                self.gpfs.make_fileset(path, fileset_name)
-            else:
-                self.gpfs.make_fileset(path, fileset_name, parent_fileset)
         else:
             logging.info("Fileset %s already exists for VO %s ... not creating again.",
                          fileset_name, self.vo.vsc_id)
@@ -297,6 +306,9 @@ class VscTier2AccountpageVo(VscAccountPageVo):
         """Set FILESET quota on the FS for the VO fileset.
         @type quota: int
         @param quota: soft quota limit expressed in KiB
+
+        With a quota writer (from the ProvisioningContext), the quota is only queued there, and the
+        grace time is only set if it was not yet set for the fileset during this run.
         """
         if not fileset_name:
             fileset_name = self.vo.vsc_id
@@ -306,8 +318,16 @@ class VscTier2AccountpageVo(VscAccountPageVo):
             soft = int(hard * self.vsc.quota_soft_fraction)
 
             # LDAP information is expressed in KiB, GPFS wants bytes.
-            self.gpfs.set_fileset_quota(soft, path, fileset_name, hard)
-            self.gpfs.set_fileset_grace(path, self.vsc.vo_storage_grace_time)  # 7 days
+            if self.quota_writer is None:
+                self.gpfs.set_fileset_quota(soft, path, fileset_name, hard)
+            else:
+                self.quota_writer.set_fileset_quota(self.storage[storage_name].filesystem, fileset_name, soft, hard,
+                                                    owner=(self.vo_id, None))
+            if self.grace_periods is None:
+                self.gpfs.set_fileset_grace(path, self.vsc.vo_storage_grace_time)  # 7 days
+            else:
+                self.grace_periods.set_fileset_grace(self.storage[storage_name].filesystem, path,
+                                                     self.vsc.vo_storage_grace_time)
         except GpfsOperationError:
             logging.exception("Unable to set quota on path %s" % (path))
             raise
@@ -358,7 +378,12 @@ class VscTier2AccountpageVo(VscAccountPageVo):
             hard = quota * 1024 * self.storage[storage_name].data_replication_factor
             soft = int(hard * self.vsc.quota_soft_fraction)
 
-            self.gpfs.set_user_quota(soft=soft, user=int(member.account.vsc_id_number), obj=path, hard=hard)
+            if self.quota_writer is None:
+                self.gpfs.set_user_quota(soft=soft, user=int(member.account.vsc_id_number), obj=path, hard=hard)
+            else:
+                self.quota_writer.set_user_quota(self.storage[storage_name].filesystem, path,
+                                                 int(member.account.vsc_id_number), soft, hard,
+                                                 owner=(self.vo_id, member.account.vsc_id))
         except GpfsOperationError:
             logging.exception("Unable to set USR quota for member %s on path %s" % (member.account.vsc_id, path))
             raise
@@ -517,73 +542,117 @@ def update_vo_status(vo, client):
                                         (vo.vo_id, virtual_organisation.status))
 
 
-def process_vos(options, vo_ids, storage_name, client, datestamp, host_institute=None):
+def process_vos(options, vo_ids, storage_name, client, datestamp, host_institute=None, rest_workers=REST_WORKERS,
+                context=None):
     """Process the virtual organisations.
 
     - make the fileset per VO
     - set the quota for the complete fileset
     - set the quota on a per-user basis for all VO members
+
+    The account page information of the VOs and their members is fetched concurrently (with rest_workers
+    threads), the filesystem changes are made one VO and member at a time. The VOs and members share
+    the given ProvisioningContext, a new one is made if not given. The quota are queued in the quota
+    writer of the context and applied in bulk once all VOs are done.
     """
 
     listm = Monoid([], lambda xs, ys: xs + ys)
     ok_vos = MonoidDict(copy.deepcopy(listm))
     error_vos = MonoidDict(copy.deepcopy(listm))
 
-    for vo_id in sorted(vo_ids):
+    if context is None:
+        context = ProvisioningContext(dry_run=options.dry_run)
 
-        vo = VscTier2AccountpageVo(vo_id, rest_client=client)
-        vo.dry_run = options.dry_run
+    vos = [VscTier2AccountpageVo(vo_id, rest_client=client, context=context) for vo_id in sorted(vo_ids)]
+    if storage_name not in [VSC_HOME]:
+        resolve_concurrently(vos, ['vo', '_institute_quota'], rest_workers)
 
+    status_vos = []  # VOs whose status is updated once their quota is known to be set
+    try:
+        for vo in vos:
+            vo_id = vo.vo_id
+            vo.dry_run = options.dry_run
+
+            try:
+                if storage_name in [VSC_HOME]:
+                    continue
+
+                if storage_name in [VSC_DATA] and vo_id not in INSTITUTE_VOS_GENT.values():
+                    vo.create_data_fileset()
+                    vo.set_data_quota()
+                    status_vos.append(vo)
+
+                if storage_name in [VSC_DATA_SHARED] and vo_id not in INSTITUTE_VOS_GENT.values() and vo.data_sharing:
+                    vo.create_data_shared_fileset()
+                    vo.set_data_shared_quota()
+
+                if vo_id == INSTITUTE_VOS_GENT[GENT]:
+                    logging.info("Not deploying default VO %s members" % (vo_id,))
+                    continue
+
+                if storage_name in GENT_PRODUCTION_SCRATCH:
+                    vo.create_scratch_fileset(storage_name)
+                    vo.set_scratch_quota(storage_name)
+
+                if vo_id in INSTITUTE_VOS_GENT.values() and storage_name in (VSC_HOME, VSC_DATA):
+                    logging.info("Not deploying default VO %s members on %s", vo_id, storage_name)
+                    continue
+
+                modified_member_list = client.vo[vo.vo_id].member.modified[datestamp].get()
+                factory = lambda vid: VscTier2AccountpageUser(vid,
+                                                              rest_client=client,
+                                                              host_institute=host_institute,
+                                                              use_user_cache=True,
+                                                              context=context)
+                modified_members = [factory(a["vsc_id"]) for a in modified_member_list[1]]
+                resolve_concurrently(modified_members, ['account', 'usergroup', 'vo_data_quota'], rest_workers)
+
+                for member in modified_members:
+                    try:
+                        member.dry_run = options.dry_run
+                        if storage_name in [VSC_DATA]:
+                            vo.set_member_data_quota(member)  # half of the VO quota
+                            vo.create_member_data_dir(member)
+
+                        if storage_name in GENT_PRODUCTION_SCRATCH:
+                            vo.set_member_scratch_quota(storage_name, member)  # half of the VO quota
+                            vo.create_member_scratch_dir(storage_name, member)
+
+                        ok_vos[vo.vo_id] = [member.account.vsc_id]
+                    except Exception:
+                        logging.exception("Failure at setting up the member %s of VO %s on %s" %
+                                          (member.account.vsc_id, vo.vo_id, storage_name))
+                        error_vos[vo.vo_id] = [member.account.vsc_id]
+            except Exception:
+                logging.exception("Something went wrong setting up the VO %s on the storage %s" %
+                                  (vo.vo_id, storage_name))
+                error_vos[vo.vo_id] = vo.members()
+    finally:
+        # the queued quota belong to this call, they must not be left for the next user of the context
+        failed = set(context.quota_writer.flush())
+
+    vos_by_id = dict([(vo.vo_id, vo) for vo in vos])
+    for (vo_id, member_id) in sorted(failed):
+        logging.error("Could not set the quota for VO %s (member %s) on %s", vo_id, member_id, storage_name)
+        if member_id:
+            error_vos[vo_id] = [member_id]
+            ok_members = [m for m in ok_vos.pop(vo_id, []) if m != member_id]
+            if ok_members:
+                ok_vos[vo_id] = ok_members
+        else:
+            error_vos[vo_id] = vos_by_id[vo_id].members()
+            ok_vos.pop(vo_id, None)
+
+    failed_vo_ids = set([vo_id for (vo_id, member_id) in failed if not member_id])
+    for vo in status_vos:
+        if vo.vo_id in failed_vo_ids:
+            logging.warning("Not updating the status of VO %s, its quota could not be set", vo.vo_id)
+            continue
         try:
-            if storage_name in [VSC_HOME]:
-                continue
-
-            if storage_name in [VSC_DATA] and vo_id not in INSTITUTE_VOS_GENT.values():
-                vo.create_data_fileset()
-                vo.set_data_quota()
-                update_vo_status(vo, client)
-
-            if storage_name in [VSC_DATA_SHARED] and vo_id not in INSTITUTE_VOS_GENT.values() and vo.data_sharing:
-                vo.create_data_shared_fileset()
-                vo.set_data_shared_quota()
-
-            if vo_id == INSTITUTE_VOS_GENT[GENT]:
-                logging.info("Not deploying default VO %s members" % (vo_id,))
-                continue
-
-            if storage_name in GENT_PRODUCTION_SCRATCH:
-                vo.create_scratch_fileset(storage_name)
-                vo.set_scratch_quota(storage_name)
-
-            if vo_id in INSTITUTE_VOS_GENT.values() and storage_name in (VSC_HOME, VSC_DATA):
-                logging.info("Not deploying default VO %s members on %s", vo_id, storage_name)
-                continue
-
-            modified_member_list = client.vo[vo.vo_id].member.modified[datestamp].get()
-            factory = lambda vid: VscTier2AccountpageUser(vid,
-                                                          rest_client=client,
-                                                          host_institute=host_institute,
-                                                          use_user_cache=True)
-            modified_members = [factory(a["vsc_id"]) for a in modified_member_list[1]]
-
-            for member in modified_members:
-                try:
-                    member.dry_run = options.dry_run
-                    if storage_name in [VSC_DATA]:
-                        vo.set_member_data_quota(member)  # half of the VO quota
-                        vo.create_member_data_dir(member)
-
-                    if storage_name in GENT_PRODUCTION_SCRATCH:
-                        vo.set_member_scratch_quota(storage_name, member)  # half of the VO quota
-                        vo.create_member_scratch_dir(storage_name, member)
-
-                    ok_vos[vo.vo_id] = [member.account.vsc_id]
-                except Exception:
-                    logging.exception("Failure at setting up the member %s of VO %s on %s" %
-                                      (member.account.vsc_id, vo.vo_id, storage_name))
-                    error_vos[vo.vo_id] = [member.account.vsc_id]
+            update_vo_status(vo, client)
         except Exception:
-            logging.exception("Something went wrong setting up the VO %s on the storage %s" % (vo.vo_id, storage_name))
-            error_vos[vo.vo_id] = vo.members
+            logging.exception("Could not update the status of VO %s", vo.vo_id)
+            error_vos[vo.vo_id] = vo.members()
+            ok_vos.pop(vo.vo_id, None)
 
     return (ok_vos, error_vos)
@@ -0,0 +1,99 @@
+#
+# Copyright 2018-2018 Ghent University
+#
+# This file is part of vsc-administration,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-administration
+#
+# All rights reserved.
+#
+"""
+Tests for vsc.administration.httpcache
+"""
+import json
+import mock
+import os
+import shutil
+import stat
+import tempfile
+
+from urllib2 import HTTPError
+
+from vsc.administration.httpcache import install_http_cache, CachedResponse
+from vsc.install.testing import TestCase
+
+
+class HttpCacheTest(TestCase):
+    """
+    Tests for the conditional GET cache.
+    """
+
+    def setUp(self):
+        super(HttpCacheTest, self).setUp()
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        super(HttpCacheTest, self).tearDown()
+
+    def test_conditional_get(self):
+        """Test that validators are stored and a 304 is served from the store."""
+        vos = json.dumps([{"vsc_id": "gvo00002"}])
+        responses = [
+            CachedResponse(200, vos, {"ETag": '"abc"'}),
+            HTTPError("https://account.vscentrum.be/api/vo/", 304, "Not Modified", None, None),
+        ]
+
+        client = mock.MagicMock()
+        client.client.url = "https://account.vscentrum.be/api/"
+        get_connection = client.client.get_connection
+        get_connection.side_effect = responses
+
+        cache = install_http_cache(client, self.path)
+
+        self.assertEqual(client.client.get_connection("GET", "vo/", None, {}).read(), vos)
+        get_connection.assert_called_with("GET", "vo/", None, {})
+
+        response = client.client.get_connection("GET", "vo/", None, {})
+        self.assertEqual((response.code, response.read()), (200, vos))
+        get_connection.assert_called_with("GET", "vo/", None, {"If-None-Match": '"abc"'})
+
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_permissions(self):
+        """Test that the store is only accessible by its owner."""
+        path = os.path.join(self.path, "store")
+        client = mock.MagicMock()
+        client.client.url = "https://account.vscentrum.be/api/"
+        client.client.get_connection.return_value = CachedResponse(200, "[]", {"ETag": '"abc"'})
+
+        install_http_cache(client, path)
+        client.client.get_connection("GET", "vo/", None, {})
+
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o700)
+        names = os.listdir(path)
+        self.assertEqual(len(names), 1)
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(path, names[0])).st_mode), 0o600)
+
+    def test_uncached(self):
+        """Test that other methods, modified listings and responses without validators are not stored."""
+        client = mock.MagicMock()
+        client.client.url = "https://account.vscentrum.be/api/"
+        get_connection = client.client.get_connection
+        get_connection.side_effect = lambda method, url, body, headers: CachedResponse(200, "[]")
+
+        cache = install_http_cache(client, self.path)
+
+        client.client.get_connection("PATCH", "vo/gvo00002/", "{}", {})
+        client.client.get_connection("GET", "vo/modified/1000/", None, {})
+        client.client.get_connection("GET", "account/", None, {})
+        client.client.get_connection("GET", "account/", None, {})
+
+        self.assertEqual(get_connection.call_args_list[-1], mock.call("GET", "account/", None, {}))
+        self.assertEqual(cache.misses, 2)
+        self.assertEqual(cache.get("https://account.vscentrum.be/api/account/"), None)
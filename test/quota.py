@@ -0,0 +1,190 @@
+#
+# Copyright 2018-2018 Ghent University
+#
+# This file is part of vsc-administration,
+# originally created by the HPC team of Ghent University (http://ugent.be/hpc/en),
+# with support of Ghent University (http://ugent.be/hpc),
+# the Flemish Supercomputer Centre (VSC) (https://www.vscentrum.be),
+# the Flemish Research Foundation (FWO) (http://www.fwo.be/en)
+# and the Department of Economy, Science and Innovation (EWI) (http://www.ewi-vlaanderen.be/en).
+#
+# https://github.com/hpcugent/vsc-administration
+#
+# All rights reserved.
+#
+"""
+Tests for vsc.administration.quota
+"""
+import mock
+import os
+import shutil
+import stat
+import tempfile
+
+from vsc.administration.quota import GracePeriods, QuotaIndex, QuotaWriter, parse_mmrepquota
+from vsc.administration.tools import FilesetInventory
+from vsc.install.testing import TestCase
+
+# stands in for mmsetquota: keeps a copy of each stanza file, fails for the device named 'broken'
+FAKE_MMSETQUOTA = """#!/bin/sh
+n=$(ls %(path)s | grep -c stanza)
+cp "$2" %(path)s/stanza.$n
+if grep -q "device=broken" "$2"; then
+    exit 1
+fi
+"""
+
+MMREPQUOTA_OUTPUT = "\n".join([
+    "mmrepquota::HEADER:version:reserved:reserved:filesystemName:quotaType:id:name:blockUsage:blockQuota:"
+    "blockLimit:blockInDoubt:blockGrace:filesUsage:filesQuota:filesLimit:filesInDoubt:filesGrace:remarks:quota:"
+    "defQuota:fid:filesetname:",
+    "mmrepquota::0:1:::kyukondata:USR:2540075:vsc40075:512:1024:2048:0:none:10:0:0:0:none:e:on:off:1:vsc400:",
+    "mmrepquota::0:1:::kyukondata:USR:2540076:vsc40076:512:1024:2048:0:none:10:0:0:0:none:e:on:off:1:vsc400:",
+    "mmrepquota::0:1:::kyukondata:FILESET:2:gvo00002:512:10240:20480:0:none:10:0:0:0:none:e:on:off:::",
+])
+
+
+class QuotaWriterTest(TestCase):
+    """
+    Tests for the batched quota writer.
+    """
+
+    def setUp(self):
+        super(QuotaWriterTest, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.mmsetquota = os.path.join(self.path, "mmsetquota")
+        with open(self.mmsetquota, "w") as f:
+            f.write(FAKE_MMSETQUOTA % {'path': self.path})
+        os.chmod(self.mmsetquota, stat.S_IRWXU)
+
+        self.gpfs = mock.MagicMock()
+        self.gpfs.dry_run = False
+        self.gpfs.list_filesets.return_value = {
+            'kyukondata': {
+                0: {'filesetName': 'root', 'path': '/kyukondata'},
+                1: {'filesetName': 'vsc400', 'path': '/kyukondata/gent/vsc400'},
+                2: {'filesetName': 'gvo00002', 'path': '/kyukondata/gent/vo/000/gvo00002'},
+            },
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        super(QuotaWriterTest, self).tearDown()
+
+    def stanzas(self):
+        names = sorted([name for name in os.listdir(self.path) if name.startswith("stanza.")])
+        return [open(os.path.join(self.path, name)).read() for name in names]
+
+    def test_flush(self):
+        """Test that the changes for a filesystem end up in a single stanza file."""
+        writer = QuotaWriter(self.gpfs, FilesetInventory(), mmsetquota=self.mmsetquota)
+
+        writer.set_user_quota('kyukondata', '/kyukondata/gent/vsc400', 2540075, 1024 * 1024, 2048 * 1024,
+                              owner='vsc40075')
+        writer.set_user_quota('kyukondata', '/kyukondata/gent/vo/000/gvo00002/', 2540075, 2048, 4096,
+                              owner='vsc40075')
+        writer.set_fileset_quota('kyukondata', 'gvo00002', 10240, 20480, owner='gvo00002')
+        # replaces the earlier change
+        writer.set_user_quota('kyukondata', '/kyukondata/gent/vsc400', 2540075, 1024, 2048, owner='vsc40075')
+        self.assertEqual(writer.pending(), 3)
+
+        self.assertEqual(writer.flush(), [])
+        self.assertEqual(writer.pending(), 0)
+        self.gpfs.set_user_quota.assert_not_called()
+
+        self.assertEqual(self.stanzas(), ["\n".join([
+            "%quota:\n  device=kyukondata\n  command=setquota\n  type=USR\n  id=2540075\n  fileset=vsc400\n"
+            "  blockQuota=1K\n  blockLimit=2K\n",
+            "%quota:\n  device=kyukondata\n  command=setquota\n  type=USR\n  id=2540075\n  fileset=gvo00002\n"
+            "  blockQuota=2K\n  blockLimit=4K\n",
+            "%quota:\n  device=kyukondata\n  command=setquota\n  type=FILESET\n  id=gvo00002\n"
+            "  blockQuota=10K\n  blockLimit=20K\n",
+        ])])
+
+    def test_chunks_and_failures(self):
+        """Test chunking, the owners of failed changes and the fallback for unknown filesets."""
+        writer = QuotaWriter(self.gpfs, FilesetInventory(), chunk_size=2, mmsetquota=self.mmsetquota)
+
+        for index in range(5):
+            writer.set_fileset_quota('kyukondata', 'gvo0000%d' % index, 1024, 2048, owner=index)
+        writer.set_fileset_quota('broken', 'gvo00009', 1024, 2048, owner=9)
+
+        writer.set_user_quota('kyukonscratch', '/kyukonscratch/gent/vsc400', 2540075, 1024, 2048)
+        self.gpfs.set_user_quota.assert_called_with(1024, 2540075, '/kyukonscratch/gent/vsc400', 2048)
+
+        self.assertEqual(writer.flush(), [9])
+        self.assertEqual(len(self.stanzas()), 4)
+
+    def test_dry_run(self):
+        """Test that nothing is written in dry run mode."""
+        self.gpfs.dry_run = True
+        writer = QuotaWriter(self.gpfs, FilesetInventory(), mmsetquota=self.mmsetquota)
+
+        writer.set_fileset_quota('kyukondata', 'gvo00002', 1024, 2048)
+        self.assertEqual(writer.flush(), [])
+        self.assertEqual(self.stanzas(), [])
+
+    def test_drift(self):
+        """Test that only the changes that differ from the mmrepquota listing are written."""
+        mmrepquota = os.path.join(self.path, "mmrepquota")
+        with open(mmrepquota, "w") as f:
+            f.write("#!/bin/sh\ncat <<EOF\n%s\nEOF\n" % MMREPQUOTA_OUTPUT)
+        os.chmod(mmrepquota, stat.S_IRWXU)
+
+        index = QuotaIndex(mmrepquota=mmrepquota)
+        writer = QuotaWriter(self.gpfs, FilesetInventory(), mmsetquota=self.mmsetquota, index=index)
+
+        writer.set_user_quota('kyukondata', '/kyukondata/gent/vsc400', 2540075, 1024 * 1024, 2048 * 1024)
+        writer.set_user_quota('kyukondata', '/kyukondata/gent/vsc400', 2540076, 1024 * 1024, 4096 * 1024)
+        writer.set_fileset_quota('kyukondata', 'gvo00002', 10240 * 1024, 20480 * 1024)
+        writer.set_fileset_quota('kyukondata', 'vsc400', 1024, 2048)
+
+        self.assertEqual(writer.unchanged['kyukondata'], 2)
+        self.assertEqual(writer.drift['kyukondata'], 2)
+        self.assertEqual(writer.flush(), [])
+        self.assertEqual(len(self.stanzas()), 1)
+        self.assertTrue("id=2540076" in self.stanzas()[0])
+        self.assertTrue("id=vsc400" in self.stanzas()[0])
+
+        # the index knows about the written limits
+        writer.set_fileset_quota('kyukondata', 'vsc400', 1024, 2048)
+        self.assertEqual(writer.pending(), 0)
+        self.assertEqual(writer.unchanged['kyukondata'], 3)
+
+    def test_parse_mmrepquota(self):
+        """Test parsing the mmrepquota listing."""
+        self.assertEqual(parse_mmrepquota(MMREPQUOTA_OUTPUT.splitlines()), {
+            ('USR', 2540075, 'vsc400'): (1024, 2048),
+            ('USR', 2540076, 'vsc400'): (1024, 2048),
+            ('FILESET', 'gvo00002', None): (10240, 20480),
+        })
+
+
+class GracePeriodsTest(TestCase):
+    """
+    Tests for setting the grace periods once per run.
+    """
+
+    def test_grace_periods(self):
+        """Test that the grace time is set once per fileset."""
+        gpfs = mock.MagicMock()
+        gpfs.list_filesets.return_value = {
+            'kyukondata': {
+                0: {'filesetName': 'vsc400', 'path': '/kyukondata/gent/vsc400'},
+                1: {'filesetName': 'gvo00002', 'path': '/kyukondata/gent/vo/000/gvo00002'},
+            },
+        }
+        grace = GracePeriods(gpfs, FilesetInventory())
+
+        grace.set_user_grace('kyukondata', '/kyukondata/gent/vsc400/vsc40075', 7 * 86400)
+        grace.set_user_grace('kyukondata', '/kyukondata/gent/vsc400/vsc40076', 7 * 86400)
+        grace.set_user_grace('kyukondata', '/kyukondata/gent/vsc400', 14 * 86400)
+        grace.set_fileset_grace('kyukondata', '/kyukondata/gent/vo/000/gvo00002', 7 * 86400)
+        grace.set_fileset_grace('kyukondata', '/kyukondata/gent/vo/000/gvo00002', 7 * 86400)
+
+        self.assertEqual(gpfs.set_user_grace.call_args_list, [
+            mock.call('/kyukondata/gent/vsc400/vsc40075', 7 * 86400),
+            mock.call('/kyukondata/gent/vsc400', 14 * 86400),
+        ])
+        gpfs.set_fileset_grace.assert_called_once_with('/kyukondata/gent/vo/000/gvo00002', 7 * 86400)
+        self.assertEqual(grace.skipped, 2)
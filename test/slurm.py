@@ -17,17 +17,54 @@ Tests for vsc.administration.slurm.*
 
 @author: Andy Georges (Ghent University)
 """
+import mock
+import os
 import shlex
+import shutil
+import sys
+import tempfile
+import threading
+import time
 
 from collections import namedtuple
 
 from vsc.install.testing import TestCase
 
+from vsc.administration.slurm.benchmark import run_benchmark
 from vsc.administration.slurm.sync import slurm_vo_accounts, slurm_user_accounts, parse_slurm_acct_dump
-from vsc.administration.slurm.sync import SyncTypes, SlurmAccount, SlurmUser
+from vsc.administration.slurm.sync import slurm_institute_accounts, SlurmAssociationIndex, coalesce_commands
+from vsc.administration.slurm.sync import SyncTypes, SlurmAccount, SlurmUser, SacctMgrException, sacctmgr_output
+from vsc.administration.slurm.sync import SacctMgrSession, SlurmAssociationTable, parse_slurm_acct_table
+from vsc.administration.slurm.sync import parse_slurm_association_dump, get_slurm_association_info
+from vsc.administration.slurm.sync import desired_state_fingerprint, get_slurm_transactions
+from vsc.administration.slurm.sync import command_dependencies, execute_command_plan
+from vsc.administration.slurm.sync import slurm_stale_accounts, slurm_vo_fairshare
+from vsc.administration.slurm.sync import planned_associations, verify_command_plan
 
 
 VO = namedtuple("VO", ["vsc_id", "institute"])
+MemberVO = namedtuple("MemberVO", ["vsc_id", "institute", "members"])
+FairshareVO = namedtuple("FairshareVO", ["vsc_id", "institute", "fairshare"])
+
+# stand-in for an interactive sacctmgr session, logging the commands it receives
+FAKE_SACCTMGR = """#!%(python)s
+import sys
+log = open(sys.argv[1], 'a')
+while True:
+    line = sys.stdin.readline()
+    if not line or line.strip() == 'exit':
+        break
+    line = line.strip()
+    if line == 'version':
+        sys.stdout.write('slurm 17.11.5\\n')
+    elif 'fail' in line:
+        sys.stdout.write(' Error with request: Nothing to do\\n')
+    else:
+        log.write(line + '\\n')
+        sys.stdout.write(' Adding ' + line + '\\n')
+    sys.stdout.flush()
+log.close()
+"""
 
 
 class SlurmSyncTest(TestCase):
@@ -120,3 +157,559 @@ class SlurmSyncTest(TestCase):
             SlurmUser(User='account2', Def_Acct='vo1', Admin='None', Cluster='banette', Account='vo1', Partition='', Share='1', MaxJobs='', MaxNodes='', MaxCPUs='', MaxSubmit='', MaxWall='', MaxCPUMins='', QOS='normal', Def_QOS=''),
             SlurmUser(User='account3', Def_Acct='vo2', Admin='None', Cluster='banette', Account='vo2', Partition='', Share='1', MaxJobs='', MaxNodes='', MaxCPUs='', MaxSubmit='', MaxWall='', MaxCPUMins='', QOS='normal', Def_QOS=''),
         ]))
+
+    def test_parse_slurm_acct_dump_stream(self):
+        """Test that the sacctmgr output can be parsed from a generator."""
+
+        def lines():
+            yield "User|Def Acct|Admin|Cluster|Account|Partition|Share|MaxJobs|MaxNodes|MaxCPUs|MaxSubmit|MaxWall|MaxCPUMins|QOS|Def QOS\n"
+            for i in range(100):
+                yield "account%d|vo1|None|banette|vo1||1|||||||normal|\n" % i
+
+        info = parse_slurm_acct_dump(lines(), SyncTypes.users)
+
+        self.assertEqual(len(info), 100)
+        self.assertEqual(set([u.User for u in info]), set(["account%d" % i for i in range(100)]))
+
+        self.assertEqual(parse_slurm_acct_dump(iter([]), SyncTypes.users), set())
+
+    def test_sacctmgr_output(self):
+        """Test that the command output is streamed and failures are reported."""
+        self.assertEqual(list(sacctmgr_output(["printf", "a\nb\n"])), ["a\n", "b\n"])
+
+        self.assertRaises(SacctMgrException, list, sacctmgr_output(["false"]))
+
+    def test_slurm_association_index(self):
+        """Test that the index answers the account and user lookups per cluster."""
+        slurm_account_info = [
+            SlurmAccount(Account='gent', Cluster='banette', Par_Name='root', User=''),
+            SlurmAccount(Account='vo1', Cluster='banette', Par_Name='gent', User=''),
+            SlurmAccount(Account='vo2', Cluster='banette2', Par_Name='gent', User=''),
+            None,
+        ]
+        slurm_user_info = [
+            SlurmUser(User='user1', Def_Acct='vo1', Cluster='banette', Account='vo1'),
+            SlurmUser(User='user2', Def_Acct='vo1', Cluster='banette', Account='vo1'),
+            SlurmUser(User='user2', Def_Acct='vo2', Cluster='banette2', Account='vo2'),
+        ]
+
+        index = SlurmAssociationIndex(slurm_account_info, slurm_user_info)
+
+        self.assertEqual(index.cluster_accounts('banette'), set(['gent', 'vo1']))
+        self.assertEqual(index.cluster_accounts('banette2'), set(['vo2']))
+        self.assertEqual(index.cluster_accounts('nosuchcluster'), set())
+        self.assertEqual(index.cluster_users('banette'), set(['user1', 'user2']))
+        self.assertEqual(index.cluster_account_users('banette', 'vo1'), set(['user1', 'user2']))
+        self.assertEqual(index.cluster_account_users('banette2', 'vo1'), set())
+        self.assertEqual(index.users['banette2']['user2'], 'vo2')
+
+        vos = [VO(vsc_id="vo1", institute={"site": "gent"}), VO(vsc_id="vo2", institute={"site": "gent"})]
+        self.assertEqual(slurm_vo_accounts(vos, index, ["banette"]), slurm_vo_accounts(vos, slurm_account_info, ["banette"]))
+        self.assertEqual(len(slurm_vo_accounts(vos, index, ["banette"])), 1)
+
+        commands = slurm_institute_accounts(index, ["banette"])
+        self.assertFalse([c for c in commands if c[3] in ('gent',)])
+
+    def test_coalesce_commands(self):
+        """Test that compatible commands are merged and the phase ordering is kept."""
+        commands = [shlex.split(c) for c in [
+            "/usr/bin/sacctmgr add user user1 Account=vo1 DefaultAccount=vo1 Cluster=banette",
+            "/usr/bin/sacctmgr add user user2 Account=vo1 DefaultAccount=vo1 Cluster=banette",
+            "/usr/bin/sacctmgr delete user name=user5 Cluster=banette",
+            "/usr/bin/sacctmgr add user user3 Account=vo2 DefaultAccount=vo2 Cluster=banette",
+            "/usr/bin/sacctmgr delete user name=user3 Account=vo1 where Cluster=banette",
+            "/usr/bin/sacctmgr add account vo3 Parent=gent Organization=ugent Cluster=banette",
+            "/usr/bin/sacctmgr add account vo3 Parent=gent Organization=ugent Cluster=banette2",
+            "/usr/bin/sacctmgr add user user1 Account=vo1 DefaultAccount=vo1 Cluster=banette2",
+            "/usr/bin/sacctmgr add user user2 Account=vo1 DefaultAccount=vo1 Cluster=banette2",
+            "/usr/bin/sacctmgr add user user4 Account=vo1 DefaultAccount=vo1 Cluster=banette3",
+            "/usr/bin/sacctmgr list user",
+        ]]
+
+        self.assertEqual(coalesce_commands(commands), [shlex.split(c) for c in [
+            "/usr/bin/sacctmgr add account vo3 Parent=gent Organization=ugent Cluster=banette,banette2",
+            "/usr/bin/sacctmgr add user user1,user2 Account=vo1 DefaultAccount=vo1 Cluster=banette,banette2",
+            "/usr/bin/sacctmgr add user user4 Account=vo1 DefaultAccount=vo1 Cluster=banette3",
+            "/usr/bin/sacctmgr add user user3 Account=vo2 DefaultAccount=vo2 Cluster=banette",
+            "/usr/bin/sacctmgr delete user name=user5 Cluster=banette",
+            "/usr/bin/sacctmgr delete user name=user3 Account=vo1 where Cluster=banette",
+            "/usr/bin/sacctmgr list user",
+        ]])
+
+        commands = [
+            shlex.split("/usr/bin/sacctmgr add user user%d Account=vo1 DefaultAccount=vo1 Cluster=banette" % i)
+            for i in range(5)
+        ]
+        self.assertEqual(coalesce_commands(commands, max_names=2), [shlex.split(c) for c in [
+            "/usr/bin/sacctmgr add user user0,user1 Account=vo1 DefaultAccount=vo1 Cluster=banette",
+            "/usr/bin/sacctmgr add user user2,user3 Account=vo1 DefaultAccount=vo1 Cluster=banette",
+            "/usr/bin/sacctmgr add user user4 Account=vo1 DefaultAccount=vo1 Cluster=banette",
+        ]])
+
+    def test_sacctmgr_session(self):
+        """Test that commands are fed to a single sacctmgr process and failures are detected."""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fake = os.path.join(tmpdir, 'sacctmgr')
+            log = os.path.join(tmpdir, 'log')
+            with open(fake, 'w') as f:
+                f.write(FAKE_SACCTMGR % {'python': sys.executable})
+            os.chmod(fake, 0o755)
+
+            with SacctMgrSession(command=[fake, log]) as session:
+                output = session.run(shlex.split("/usr/bin/sacctmgr add account vo1 Parent=gent Cluster=banette"))
+                self.assertEqual(output, [" Adding add account vo1 Parent=gent Cluster=banette\n"])
+                session.run(["add", "user", "user1", "Account=vo1", "Cluster=banette"])
+                pid = session.process.pid
+                self.assertRaises(SacctMgrException, session.run, ["fail"])
+                self.assertEqual(session.process.pid, pid)
+
+            self.assertEqual(session.process, None)
+            with open(log) as f:
+                self.assertEqual(f.read().splitlines(), [
+                    "add account vo1 Parent=gent Cluster=banette",
+                    "add user user1 Account=vo1 Cluster=banette",
+                ])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_slurm_user_accounts_affected_users(self):
+        """Test that only the associations of the affected users are synchronised."""
+        vo_members = {
+            "vo1": (set(["user1", "user2"]), VO(vsc_id="vo1", institute={"site": "gent"})),
+            "vo2": (set(["user3", "user4", "user6"]), VO(vsc_id="vo2", institute={"site": "gent"})),
+        }
+        active_accounts = set(["user1", "user3", "user4", "user6"])
+        slurm_user_info = [
+            SlurmUser(User='user1', Def_Acct='vo1', Cluster='banette', Account='vo1'),
+            SlurmUser(User='user2', Def_Acct='vo1', Cluster='banette', Account='vo1'),
+            SlurmUser(User='user3', Def_Acct='vo1', Cluster='banette', Account='vo1'),
+            SlurmUser(User='user4', Def_Acct='vo2', Cluster='banette', Account='vo2'),
+            SlurmUser(User='user5', Def_Acct='vo1', Cluster='banette', Account='vo1'),
+            SlurmUser(User='user7', Def_Acct='vo3', Cluster='banette', Account='vo3'),
+        ]
+
+        commands = slurm_user_accounts(vo_members, active_accounts, slurm_user_info, ["banette"],
+                                       affected_users=set(["user1", "user2", "user3", "user4", "user5", "user6"]))
+
+        self.assertEqual(set([tuple(x) for x in commands]), set([tuple(x) for x in [
+            shlex.split("/usr/bin/sacctmgr add user user6 Account=vo2 DefaultAccount=vo2 Cluster=banette"),
+            shlex.split("/usr/bin/sacctmgr delete user name=user2 Cluster=banette"),
+            shlex.split("/usr/bin/sacctmgr delete user name=user5 Cluster=banette"),
+            shlex.split("/usr/bin/sacctmgr add user user3 Account=vo2 DefaultAccount=vo2 Cluster=banette"),
+            shlex.split("/usr/bin/sacctmgr delete user name=user3 Account=vo1 where Cluster=banette"),
+        ]]))
+
+    def test_slurm_user_accounts_unmodified_vo(self):
+        """Test that a modified active account in an unmodified VO is not removed."""
+        vo_members = {
+            "vo2": (set(["user2"]), VO(vsc_id="vo2", institute={"site": "gent"})),
+        }
+        active_accounts = set(["user1", "user2"])
+        slurm_user_info = [
+            SlurmUser(User='user1', Def_Acct='vo1', Cluster='banette', Account='vo1'),
+            SlurmUser(User='user2', Def_Acct='vo2', Cluster='banette', Account='vo2'),
+            SlurmUser(User='user3', Def_Acct='vo1', Cluster='banette', Account='vo1'),
+        ]
+
+        commands = slurm_user_accounts(vo_members, active_accounts, slurm_user_info, ["banette"],
+                                       affected_users=set(["user1", "user2", "user3"]))
+
+        self.assertEqual(commands, [shlex.split("/usr/bin/sacctmgr delete user name=user3 Cluster=banette")])
+
+    def test_slurm_association_table(self):
+        """Test the columnar storage of the parsed sacctmgr output."""
+        sacctmgr_user_output = [
+            "User|Def Acct|Admin|Cluster|Account|Partition|Share|MaxJobs|MaxNodes|MaxCPUs|MaxSubmit|MaxWall|MaxCPUMins|QOS|Def QOS",
+            "root|root|Administrator|banette|root||1|||||||normal|",
+            "account1|vo1|None|banette|vo1||1|||||||normal|",
+            "account2|vo1|None|banette|vo1||1|||||||normal|",
+            "account3|vo2|None|banette2|vo2||1|||||||normal|",
+        ]
+
+        table = parse_slurm_acct_table(sacctmgr_user_output, SyncTypes.users)
+
+        self.assertEqual(len(table), 3)
+        self.assertEqual(set(table), parse_slurm_acct_dump(sacctmgr_user_output, SyncTypes.users))
+        self.assertEqual(list(table.rows("User", "Cluster")), [
+            ("account1", "banette"), ("account2", "banette"), ("account3", "banette2"),
+        ])
+        # every distinct string is stored once
+        self.assertEqual(len(table.values), len(set(table.values)))
+        self.assertEqual(table.values.count("banette"), 1)
+
+        index = SlurmAssociationIndex(slurm_user_info=table)
+        self.assertEqual(index.cluster_account_users("banette", "vo1"), set(["account1", "account2"]))
+
+        other = SlurmAssociationTable(SlurmUser)
+        other.append(SlurmUser(User='account4', Def_Acct='vo3', Cluster='banette3', Account='vo3'))
+        table.extend(other)
+        self.assertEqual(len(table), 4)
+        self.assertTrue(SlurmUser(User='account4', Def_Acct='vo3', Cluster='banette3', Account='vo3') in set(table))
+
+    def test_parse_slurm_association_dump(self):
+        """Test that the association listing is split in account and user information."""
+        sacctmgr_association_output = [
+            "Cluster|Account|User|Par Name|Share",
+            "banette|root|||1",
+            "banette|root|root||1",
+            "banette|gent||root|1",
+            "banette|vo1||gent|1",
+            "banette|vo1|account1||1",
+            "banette2|vo2|account1||1",
+        ]
+
+        default_accounts = {("banette", "account1"): "vo1", ("banette2", "account1"): "vo2"}
+        (accounts, users) = parse_slurm_association_dump(sacctmgr_association_output, default_accounts)
+
+        self.assertEqual(set(accounts), set([
+            SlurmAccount(Account='gent', Cluster='banette', Par_Name='root', User='', Share='1'),
+            SlurmAccount(Account='vo1', Cluster='banette', Par_Name='gent', User='', Share='1'),
+        ]))
+        self.assertEqual(set(users), set([
+            SlurmUser(User='account1', Def_Acct='vo1', Cluster='banette', Account='vo1', Share='1'),
+            SlurmUser(User='account1', Def_Acct='vo2', Cluster='banette2', Account='vo2', Share='1'),
+        ]))
+
+    @mock.patch('vsc.administration.slurm.sync.sacctmgr_output')
+    def test_get_slurm_association_info_clusters(self, mock_sacctmgr_output):
+        """Test that each cluster is queried separately and the results are merged."""
+        def output(command):
+            cluster = [c.split("=")[1] for c in command if c.startswith("cluster=")][0]
+            if "users" in command:
+                return iter(["account1|%s|vo2" % cluster, "account1|%s|vo2" % cluster])
+            return iter([
+                "Cluster|Account|User|Par Name|Share",
+                "%s|vo1||gent|1" % cluster,
+                "%s|vo1|account1||1" % cluster,
+                "%s|vo2|account1||1" % cluster,
+            ])
+        mock_sacctmgr_output.side_effect = output
+
+        (accounts, users) = get_slurm_association_info(["banette", "banette2", "banette3"], workers=2)
+
+        # an association and a default account listing per cluster
+        self.assertEqual(mock_sacctmgr_output.call_count, 6)
+        for args in mock_sacctmgr_output.call_args_list:
+            self.assertTrue(args[0][0][-1].startswith("format="))
+        self.assertEqual(sorted(accounts.column("Cluster")), ["banette", "banette2", "banette3"])
+        self.assertEqual(sorted(users.rows("User", "Cluster", "Account", "Def_Acct")), [
+            ("account1", "banette", "vo1", "vo2"), ("account1", "banette", "vo2", "vo2"),
+            ("account1", "banette2", "vo1", "vo2"), ("account1", "banette2", "vo2", "vo2"),
+            ("account1", "banette3", "vo1", "vo2"), ("account1", "banette3", "vo2", "vo2"),
+        ])
+
+    def test_slurm_user_accounts_secondary_account(self):
+        """Test that an association with an account other than the default account is left alone."""
+        vo_members = {
+            "vo1": (set(["user1"]), VO(vsc_id="vo1", institute={"site": "gent"})),
+            "vo2": (set(["user2"]), VO(vsc_id="vo2", institute={"site": "gent"})),
+        }
+        active_accounts = set(["user1", "user2"])
+        (_, slurm_user_info) = parse_slurm_association_dump([
+            "Cluster|Account|User|Par Name|Share",
+            "banette|vo1|user1||1",
+            "banette|vo2|user1||1",
+            "banette|vo2|user2||1",
+        ], {("banette", "user1"): "vo1", ("banette", "user2"): "vo2"})
+
+        commands = slurm_user_accounts(vo_members, active_accounts, slurm_user_info, ["banette"])
+
+        self.assertEqual(commands, [])
+
+    def test_desired_state_fingerprint(self):
+        """Test that the fingerprint only changes when the desired state changes."""
+        vos = [
+            MemberVO(vsc_id="vo1", institute={"site": "gent"}, members=["user1", "user2"]),
+            MemberVO(vsc_id="vo2", institute={"site": "gent"}, members=["user3"]),
+        ]
+        active = set(["user1", "user2", "user3"])
+
+        fingerprint = desired_state_fingerprint(vos, active, ["banette", "banette2"])
+
+        reordered = [MemberVO(vsc_id="vo2", institute={"site": "gent"}, members=["user3"]),
+                     MemberVO(vsc_id="vo1", institute={"site": "gent"}, members=["user2", "user1"])]
+        self.assertEqual(desired_state_fingerprint(reordered, active, ["banette2", "banette"]), fingerprint)
+
+        moved = [MemberVO(vsc_id="vo1", institute={"site": "gent"}, members=["user1"]),
+                 MemberVO(vsc_id="vo2", institute={"site": "gent"}, members=["user2", "user3"])]
+        self.assertNotEqual(desired_state_fingerprint(moved, active, ["banette", "banette2"]), fingerprint)
+        self.assertNotEqual(desired_state_fingerprint(vos, set(["user1"]), ["banette", "banette2"]), fingerprint)
+        self.assertNotEqual(desired_state_fingerprint(vos, active, ["banette"]), fingerprint)
+
+    @mock.patch('vsc.administration.slurm.sync.sacctmgr_output')
+    def test_get_slurm_transactions(self, mock_sacctmgr_output):
+        """Test that the transaction listing is requested from the given time on."""
+        mock_sacctmgr_output.return_value = iter(["\n"])
+        self.assertEqual(get_slurm_transactions(0), [])
+
+        mock_sacctmgr_output.return_value = iter(["2018-04-01T10:00:00|Add Users|name='user1'\n"])
+        self.assertEqual(get_slurm_transactions(0), ["2018-04-01T10:00:00|Add Users|name='user1'"])
+        self.assertTrue([a for a in mock_sacctmgr_output.call_args[0][0] if a.startswith("Start=")])
+
+    def test_benchmark(self):
+        """Test that the benchmark runs all stages and reports the command counts."""
+        result = run_benchmark(users=200, vos=10, clusters=2, drift=0.2)
+
+        self.assertEqual([s["stage"] for s in result["stages"]], [
+            "generate",
+            "generate_slurm",
+            "parse_slurm_acct_table",
+            "parse_slurm_association_dump",
+            "index",
+            "slurm_institute_accounts",
+            "slurm_vo_accounts",
+            "slurm_user_accounts",
+            "coalesce_commands",
+        ])
+        for stage in result["stages"]:
+            self.assertTrue(stage["wall_time"] >= 0)
+            self.assertTrue(stage.get("stage_peak_rss_kb", stage.get("process_peak_rss_kb")) > 0)
+        self.assertEqual(result["commands"]["vo"], 0)
+        self.assertTrue(result["commands"]["user"] > 0)
+        self.assertTrue(result["commands"]["coalesced"] <= result["commands"]["user"])
+        # runs with the same seed plan the same commands
+        self.assertEqual(result["commands"], run_benchmark(users=200, vos=10, clusters=2, drift=0.2)["commands"])
+
+    def test_command_dependencies(self):
+        """Test that accounts precede their users and the add half of a change precedes the delete half."""
+        commands = [shlex.split(c) for c in [
+            "/usr/bin/sacctmgr add account vo1 Parent=gent Organization=ugent Cluster=banette",
+            "/usr/bin/sacctmgr add account vo2 Parent=gent Organization=ugent Cluster=banette,banette2",
+            "/usr/bin/sacctmgr add user user1 Account=vo1 DefaultAccount=vo1 Cluster=banette",
+            "/usr/bin/sacctmgr add user user2 Account=vo2 DefaultAccount=vo2 Cluster=banette2",
+            "/usr/bin/sacctmgr add user user3 Account=vo3 DefaultAccount=vo3 Cluster=banette",
+            "/usr/bin/sacctmgr delete user name=user3 Account=vo1 where Cluster=banette",
+            "/usr/bin/sacctmgr delete user name=user4 Cluster=banette2",
+            "/usr/bin/sacctmgr list user",
+            "/usr/bin/sacctmgr delete user name=user5 Cluster=banette2",
+        ]]
+
+        self.assertEqual(command_dependencies(commands), [
+            set(),
+            set(),
+            set([0]),
+            set([1]),
+            set(),
+            set([0, 4]),
+            set(),
+            set([0, 1, 2, 3, 4, 5, 6]),
+            set([7]),
+        ])
+
+    def test_execute_command_plan(self):
+        """Test that the plan is executed concurrently while respecting the dependencies."""
+        commands = [shlex.split(c) for c in [
+            "/usr/bin/sacctmgr add account vo1 Parent=gent Organization=ugent Cluster=banette",
+            "/usr/bin/sacctmgr add account vo2 Parent=gent Organization=ugent Cluster=banette2",
+            "/usr/bin/sacctmgr add user user1 Account=vo1 DefaultAccount=vo1 Cluster=banette",
+            "/usr/bin/sacctmgr add user user2 Account=vo2 DefaultAccount=vo2 Cluster=banette2",
+            "/usr/bin/sacctmgr delete user name=user2 Account=vo3 where Cluster=banette2",
+        ]]
+        dependencies = command_dependencies(commands)
+
+        lock = threading.Lock()
+        finished = []
+        running = []
+        concurrency = []
+
+        def run(command):
+            with lock:
+                idx = commands.index(command)
+                # every dependency has completed before the command starts
+                self.assertTrue(dependencies[idx] <= set(finished))
+                running.append(idx)
+                concurrency.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(idx)
+                finished.append(idx)
+
+        execute_command_plan(commands, run, parallel=4)
+
+        self.assertEqual(sorted(finished), range(len(commands)))
+        self.assertTrue(max(concurrency) > 1)
+
+        def fail(command):
+            if command[2] == "account":
+                raise SacctMgrException("Command failed")
+            finished.append(command)
+
+        finished = []
+        self.assertRaises(SacctMgrException, execute_command_plan, commands, fail, 4)
+        self.assertEqual(finished, [])
+
+    def test_slurm_user_accounts_existing_association(self):
+        """Test that only the default account is changed when the user already is in the new account."""
+        vo_members = {
+            "vo1": (set(["user1"]), VO(vsc_id="vo1", institute={"site": "gent"})),
+            "vo2": (set(["user2", "user3"]), VO(vsc_id="vo2", institute={"site": "gent"})),
+        }
+        active_accounts = set(["user1", "user2", "user3"])
+        (_, slurm_user_info) = parse_slurm_association_dump([
+            "Cluster|Account|User|Par Name|Share",
+            "banette|vo1|user1||1",
+            "banette|vo1|user2||1",
+            "banette|vo2|user2||1",
+            "banette|vo1|user3||1",
+        ], {("banette", "user1"): "vo1", ("banette", "user2"): "vo1", ("banette", "user3"): "vo1"})
+
+        commands = slurm_user_accounts(vo_members, active_accounts, slurm_user_info, ["banette"])
+
+        self.assertEqual(set([tuple(x) for x in commands]), set([tuple(x) for x in [
+            shlex.split("/usr/bin/sacctmgr modify user where name=user2 Cluster=banette set DefaultAccount=vo2"),
+            shlex.split("/usr/bin/sacctmgr delete user name=user2 Account=vo1 where Cluster=banette"),
+            shlex.split("/usr/bin/sacctmgr add user user3 Account=vo2 DefaultAccount=vo2 Cluster=banette"),
+            shlex.split("/usr/bin/sacctmgr delete user name=user3 Account=vo1 where Cluster=banette"),
+        ]]))
+
+        # the default account change is issued before the old association is removed
+        self.assertEqual([c[1] for c in coalesce_commands(commands)], ["add", "modify", "delete"])
+
+    def test_slurm_stale_accounts(self):
+        """Test that accounts of deleted VOs are removed, up to the safety limit."""
+        slurm_account_info = [
+            SlurmAccount(Account='gent', Cluster='banette', Par_Name='root', User=''),
+            SlurmAccount(Account='gvo00012', Cluster='banette', Par_Name='gent', User=''),
+            SlurmAccount(Account='vo1', Cluster='banette', Par_Name='gent', User=''),
+            SlurmAccount(Account='vo2', Cluster='banette', Par_Name='gent', User=''),
+            SlurmAccount(Account='vo3', Cluster='banette', Par_Name='gent', User=''),
+            SlurmAccount(Account='vo3', Cluster='banette2', Par_Name='gent', User=''),
+        ]
+        vos = [VO(vsc_id="vo1", institute={"site": "gent"})]
+
+        (commands, skipped) = slurm_stale_accounts(vos, slurm_account_info, ["banette", "banette2"])
+
+        self.assertEqual(skipped, 0)
+        self.assertEqual(commands, [shlex.split(c) for c in [
+            "/usr/bin/sacctmgr delete account name=vo2 Cluster=banette",
+            "/usr/bin/sacctmgr delete account name=vo3 Cluster=banette",
+            "/usr/bin/sacctmgr delete account name=vo3 Cluster=banette2",
+        ]])
+        self.assertEqual(coalesce_commands(commands), [shlex.split(c) for c in [
+            "/usr/bin/sacctmgr delete account name=vo2,vo3 Cluster=banette",
+            "/usr/bin/sacctmgr delete account name=vo3 Cluster=banette2",
+        ]])
+
+        self.assertEqual(slurm_stale_accounts(vos, slurm_account_info, ["banette", "banette2"], max_removals=2),
+                         ([], 3))
+
+    def test_slurm_stale_accounts_limit(self):
+        """Test that users and VOs are still added when too many stale accounts are held back."""
+        slurm_account_info = [
+            SlurmAccount(Account='gent', Cluster='banette', Par_Name='root', User=''),
+            SlurmAccount(Account='vo1', Cluster='banette', Par_Name='gent', User=''),
+            SlurmAccount(Account='vo8', Cluster='banette', Par_Name='gent', User=''),
+            SlurmAccount(Account='vo9', Cluster='banette', Par_Name='gent', User=''),
+        ]
+        vos = [VO(vsc_id="vo1", institute={"site": "gent"}), VO(vsc_id="vo2", institute={"site": "gent"})]
+        vo_members = {"vo2": (set(["user1"]), vos[1])}
+        index = SlurmAssociationIndex(slurm_account_info, [])
+
+        commands = slurm_vo_accounts(vos, index, ["banette"])
+        commands += slurm_user_accounts(vo_members, set(["user1"]), index, ["banette"])
+        (stale_commands, skipped) = slurm_stale_accounts(vos, index, ["banette"], max_removals=1)
+        commands += stale_commands
+
+        self.assertEqual(skipped, 2)
+        self.assertEqual(coalesce_commands(commands), [shlex.split(c) for c in [
+            "/usr/bin/sacctmgr add account vo2 Parent=gent Organization=ugent Cluster=banette",
+            "/usr/bin/sacctmgr add user user1 Account=vo2 DefaultAccount=vo2 Cluster=banette",
+        ]])
+
+    def test_slurm_stale_accounts_users(self):
+        """Test that the users of a stale account are moved to their VO before the account is removed."""
+        (slurm_account_info, slurm_user_info) = parse_slurm_association_dump([
+            "Cluster|Account|User|Par Name|Share",
+            "banette|gent||root|1",
+            "banette|vo1||gent|1",
+            "banette|vodeleted||gent|1",
+            "banette|vodeleted|user1||1",
+        ], {("banette", "user1"): "vodeleted"})
+        index = SlurmAssociationIndex(slurm_account_info, slurm_user_info)
+        vos = [VO(vsc_id="vo1", institute={"site": "gent"})]
+        vo_members = {"vo1": (set(["user1"]), vos[0])}
+
+        commands = slurm_user_accounts(vo_members, set(["user1"]), index, ["banette"])
+        commands += slurm_stale_accounts(vos, index, ["banette"])[0]
+
+        self.assertEqual(coalesce_commands(commands), [shlex.split(c) for c in [
+            "/usr/bin/sacctmgr add user user1 Account=vo1 DefaultAccount=vo1 Cluster=banette",
+            "/usr/bin/sacctmgr delete user name=user1 Account=vodeleted where Cluster=banette",
+            "/usr/bin/sacctmgr delete account name=vodeleted Cluster=banette",
+        ]])
+
+        # an incremental sync does not know all VOs, so it leaves the users alone
+        self.assertEqual(slurm_user_accounts(vo_members, set(["user1"]), index, ["banette"],
+                                             affected_users=set(["user2"])), [])
+
+    def test_slurm_vo_fairshare(self):
+        """Test that accounts with a changed fairshare are grouped per value."""
+        slurm_account_info = [
+            SlurmAccount(Account='vo1', Cluster='banette', Par_Name='gent', User='', Share='100'),
+            SlurmAccount(Account='vo2', Cluster='banette', Par_Name='gent', User='', Share='1'),
+            SlurmAccount(Account='vo3', Cluster='banette', Par_Name='gent', User='', Share='1'),
+            SlurmAccount(Account='vo1', Cluster='banette2', Par_Name='gent', User='', Share='100'),
+            SlurmAccount(Account='vo2', Cluster='banette2', Par_Name='gent', User='', Share='100'),
+        ]
+        vos = [
+            FairshareVO(vsc_id="vo1", institute={"site": "gent"}, fairshare=100),
+            FairshareVO(vsc_id="vo2", institute={"site": "gent"}, fairshare=100),
+            FairshareVO(vsc_id="vo3", institute={"site": "gent"}, fairshare=100),
+            FairshareVO(vsc_id="vo4", institute={"site": "gent"}, fairshare=None),
+        ]
+
+        commands = slurm_vo_fairshare(vos, slurm_account_info, ["banette", "banette2"])
+
+        self.assertEqual(commands, [shlex.split(c) for c in [
+            "/usr/bin/sacctmgr modify account where name=vo2,vo3 Cluster=banette set Fairshare=100",
+            "/usr/bin/sacctmgr modify account where name=vo3 Cluster=banette2 set Fairshare=100",
+        ]])
+
+    @mock.patch('vsc.administration.slurm.sync.sacctmgr_output')
+    def test_verify_command_plan(self, mock_sacctmgr_output):
+        """Test that only the touched entities are queried and compared with the plan."""
+        commands = [shlex.split(c) for c in [
+            "/usr/bin/sacctmgr add account vo3 Parent=gent Organization=ugent Cluster=banette",
+            "/usr/bin/sacctmgr add user user1,user2 Account=vo3 DefaultAccount=vo3 Cluster=banette",
+            "/usr/bin/sacctmgr modify account where name=vo3 Cluster=banette set Fairshare=100",
+            "/usr/bin/sacctmgr delete user name=user1 Account=vo1 where Cluster=banette",
+            "/usr/bin/sacctmgr delete user name=user4 Cluster=banette",
+        ]]
+
+        (associations, shares) = planned_associations(commands)
+        self.assertEqual(associations, {
+            ("banette", "vo3", ""): True,
+            ("banette", "vo3", "user1"): True,
+            ("banette", "vo3", "user2"): True,
+            ("banette", "vo1", "user1"): False,
+            ("banette", None, "user4"): False,
+        })
+        self.assertEqual(shares, {("banette", "vo3"): "100"})
+
+        def output(command):
+            if "users=user1,user2,user4" in command:
+                return iter([
+                    "Cluster|Account|User|Par Name|Share",
+                    "banette|vo3|user1||1",
+                    "banette|vo1|user1||1",
+                ])
+            return iter([
+                "Cluster|Account|User|Par Name|Share",
+                "banette|vo3||gent|100",
+                "banette|vo3|user1||1",
+            ])
+        mock_sacctmgr_output.side_effect = output
+
+        mismatches = verify_command_plan(commands)
+
+        self.assertEqual(mock_sacctmgr_output.call_count, 2)
+        self.assertTrue("accounts=vo3" in mock_sacctmgr_output.call_args_list[1][0][0])
+        # same cluster filter as the complete listing
+        for args in mock_sacctmgr_output.call_args_list:
+            self.assertTrue("cluster=banette" in args[0][0])
+        self.assertEqual(mismatches, [
+            "association Cluster=banette Account=vo3 User=user2 is missing",
+            "association Cluster=banette Account=vo1 User=user1 was not removed",
+        ])
+        self.assertEqual(verify_command_plan([]), [])
@@ -18,10 +18,11 @@ Tests for vsc.administration.vo
 @author: Andy Georges (Ghent University)
 """
 import mock
+import threading
 
 from collections import namedtuple
 
-from vsc.administration.tools import create_stat_directory
+from vsc.administration.tools import create_stat_directory, map_grouped, resolve_concurrently, FilesetInventory
 from vsc.install.testing import TestCase
 
 
@@ -136,3 +137,123 @@ class StatDirTest(TestCase):
         mock_os_stat.assert_called_with(test_path)
         self.assertFalse(mock_posix.make_dir.called)
         mock_posix.chmod.assert_called_with(test_permissions, test_path)
+
+
+class ResolveConcurrentlyTest(TestCase):
+    """
+    Tests for resolving REST backed attributes in worker threads.
+    """
+
+    def test_resolve_concurrently(self):
+        """Test that all attributes are resolved, in order, and failures do not stop the other entities."""
+
+        class Entity(object):
+            def __init__(self, name):
+                self.name = name
+                self.resolved = []
+                self.threads = set()
+
+            def __getattr__(self, attribute):
+                if attribute not in ('first', 'second'):
+                    raise AttributeError(attribute)
+                self.threads.add(threading.current_thread().name)
+                if self.name == 'broken':
+                    raise ValueError("no %s for %s" % (attribute, self.name))
+                self.resolved.append(attribute)
+                return attribute
+
+        entities = [Entity('e%d' % i) for i in range(10)] + [Entity('broken')]
+        resolve_concurrently(entities, ['first', 'second'], workers=4)
+
+        for entity in entities[:-1]:
+            self.assertEqual(entity.resolved, ['first', 'second'])
+            self.assertFalse(threading.current_thread().name in entity.threads)
+        self.assertEqual(entities[-1].resolved, [])
+
+        # a single worker leaves everything to the sequential processing
+        entity = Entity('e')
+        resolve_concurrently([entity, Entity('f')], ['first'], workers=1)
+        self.assertEqual(entity.resolved, [])
+
+
+class MapGroupedTest(TestCase):
+    """
+    Tests for applying a function per group, first one at a time, then in worker threads.
+    """
+
+    def test_map_grouped(self):
+        """Test that the first entity of each group is handled up front in the calling thread."""
+        calls = []
+
+        def func(name):
+            calls.append((name, threading.current_thread().name))
+            return name.upper()
+
+        main_thread = threading.current_thread().name
+        names = ['vsc40001', 'vsc40002', 'vsc40101', 'vsc40003', 'vsc40102', 'vsc40201']
+        results = map_grouped(func, names, lambda name: name[:6], workers=3)
+
+        self.assertEqual(results, [name.upper() for name in names])
+        self.assertEqual(calls[:3], [('vsc40001', main_thread), ('vsc40101', main_thread), ('vsc40201', main_thread)])
+        self.assertEqual(sorted([name for (name, _) in calls[3:]]), ['vsc40002', 'vsc40003', 'vsc40102'])
+        self.assertFalse(main_thread in [thread for (_, thread) in calls[3:]])
+
+    def test_map_grouped_serial(self):
+        """Test that entities without a group and the rest of a failed group are handled in the calling thread."""
+        calls = []
+
+        def func(name):
+            calls.append((name, threading.current_thread().name))
+            return name != 'vsc40001'
+
+        def group(name):
+            return None if name.startswith('x') else name[:6]
+
+        main_thread = threading.current_thread().name
+        names = ['vsc40001', 'x0001', 'vsc40002', 'x0002', 'vsc40101', 'vsc40003', 'vsc40102']
+        results = map_grouped(func, names, group, workers=3)
+
+        self.assertEqual(results, [False, True, True, True, True, True, True])
+        threads = dict(calls)
+        self.assertEqual([name for (name, _) in calls[:6]],
+                         ['vsc40001', 'x0001', 'x0002', 'vsc40101', 'vsc40002', 'vsc40003'])
+        self.assertTrue(all([threads[name] == main_thread for (name, _) in calls[:6]]))
+        self.assertNotEqual(threads['vsc40102'], main_thread)
+
+
+class FilesetInventoryTest(TestCase):
+    """
+    Tests for the shared GPFS fileset inventory.
+    """
+
+    def test_inventory(self):
+        """Test that each filesystem is listed once and created filesets are added."""
+        gpfs = mock.MagicMock()
+        gpfs.list_filesets.side_effect = lambda devices, update: {
+            'kyukondata': {0: {'filesetName': 'root'}, 1: {'filesetName': 'vsc400'}},
+        } if devices == ['kyukondata'] else {}
+
+        inventory = FilesetInventory()
+        self.assertEqual(inventory.get_fileset_info(gpfs, 'kyukondata', 'vsc400'), {'filesetName': 'vsc400'})
+        self.assertEqual(inventory.get_fileset_info(gpfs, 'kyukondata', 'vsc401'), None)
+
+        self.assertTrue(inventory.make_fileset(gpfs, 'kyukondata', '/data/gent/vsc401', 'vsc401'))
+        gpfs.make_dir.assert_called_with('/data/gent')
+        gpfs.make_fileset.assert_called_with('/data/gent/vsc401', 'vsc401')
+        self.assertEqual(inventory.get_fileset_info(gpfs, 'kyukondata', 'vsc401')['path'], '/data/gent/vsc401')
+
+        # existing filesets are not created again
+        self.assertFalse(inventory.make_fileset(gpfs, 'kyukondata', '/data/gent/vsc400', 'vsc400'))
+        self.assertEqual(gpfs.make_fileset.call_count, 1)
+
+        inventory.make_fileset(gpfs, 'kyukonhome', '/home/gent/vsc401', 'vsc401', 'root')
+        gpfs.make_fileset.assert_called_with('/home/gent/vsc401', 'vsc401', 'root')
+
+        self.assertEqual(gpfs.list_filesets.call_args_list, [
+            mock.call(devices=['kyukondata'], update=True),
+            mock.call(devices=['kyukonhome'], update=True),
+        ])
+
+        inventory.invalidate('kyukondata')
+        inventory.get_fileset_info(gpfs, 'kyukondata', 'vsc400')
+        self.assertEqual(gpfs.list_filesets.call_count, 3)
@@ -22,6 +22,7 @@ import mock
 import os
 
 from collections import namedtuple
+from urllib2 import HTTPError
 
 import vsc.administration.user as user
 import vsc.config.base as config
@@ -326,6 +327,149 @@ class VscTier2AccountpageUserTest(TestCase):
         self.assertEqual(accountpageuser.user_home_quota, [q['hard'] for q in test_quota_1 if q['storage']['name'] == 'VSC_HOME' and q['fileset'] == 'vsc400'][0])
         self.assertEqual(accountpageuser.user_data_quota, [q['hard'] for q in test_quota_1 if q['storage']['name'] == 'VSC_DATA' and q['fileset'] == 'vsc400'][0])
 
+    @mock.patch('vsc.administration.user.PosixOperations', autospec=True)
+    @mock.patch('vsc.administration.user.GpfsOperations', autospec=True)
+    def test_provisioning_context(self, mock_gpfs, mock_posix):
+
+        mock_client = mock.MagicMock()
+        context = user.ProvisioningContext(gpfs=mock.MagicMock(), posix=mock.MagicMock(), filesets=mock.MagicMock())
+
+        users = [user.VscTier2AccountpageUser(vsc_id, rest_client=mock_client, context=context)
+                 for vsc_id in ('vsc40075', 'vsc40002')]
+        for accountpageuser in users:
+            self.assertTrue(accountpageuser.gpfs is context.gpfs)
+            self.assertTrue(accountpageuser.posix is context.posix)
+            self.assertTrue(accountpageuser.storage is context.storage)
+            self.assertTrue(accountpageuser.filesets is context.filesets)
+
+        mock_gpfs.assert_not_called()
+        mock_posix.assert_not_called()
+
+        context.dry_run = True
+        self.assertEqual(context.gpfs.dry_run, True)
+        self.assertEqual(context.posix.dry_run, True)
+
+
+class UserCacheTest(TestCase):
+    """
+    Tests for the bounded user cache.
+    """
+
+    def test_lru(self):
+
+        cache = user.UserCache(max_size=2)
+        cache.entry('VscTier2AccountpageUser', 'vsc40001')['account'] = 1
+        cache.entry('VscTier2AccountpageUser', 'vsc40002')['account'] = 2
+
+        # vsc40001 was used last, so vsc40002 is dropped
+        self.assertEqual(cache.entry('VscTier2AccountpageUser', 'vsc40001'), {'account': 1})
+        cache.entry('VscTier2AccountpageUser', 'vsc40003')
+
+        self.assertEqual(cache.peek('VscTier2AccountpageUser', 'vsc40002'), None)
+        self.assertEqual(cache.peek('VscTier2AccountpageUser', 'vsc40001'), {'account': 1})
+        self.assertEqual(cache.stats(), {
+            'hits': 1, 'misses': 3, 'expired': 0, 'evicted': 1, 'invalidated': 0, 'size': 2,
+        })
+
+    @mock.patch('vsc.administration.user.time')
+    def test_ttl(self, mock_time):
+
+        cache = user.UserCache(ttl=60)
+        mock_time.time.return_value = 1000
+        cache.entry('VscTier2AccountpageUser', 'vsc40001')['account'] = 1
+
+        mock_time.time.return_value = 1060
+        self.assertEqual(cache.entry('VscTier2AccountpageUser', 'vsc40001'), {'account': 1})
+
+        mock_time.time.return_value = 1061
+        self.assertEqual(cache.peek('VscTier2AccountpageUser', 'vsc40001'), None)
+        self.assertEqual(cache.entry('VscTier2AccountpageUser', 'vsc40001'), {})
+        self.assertEqual(cache.stats()['expired'], 1)
+
+    def test_invalidate_modified(self):
+
+        mock_client = mock.MagicMock()
+        mock_client.account.modified[1000].get.return_value = (200, [test_account_1])
+        mock_client.quota.user.storage[VSC_HOME].modified[1000].get.return_value = (200, [{'user': 'vsc40002'}])
+
+        cache = user.UserCache()
+        for vsc_id in ('vsc40075', 'vsc40002', 'vsc40003'):
+            cache.entry('VscAccountPageUser', vsc_id)
+            cache.entry('VscTier2AccountpageUser', vsc_id)
+
+        self.assertEqual(cache.invalidate_modified(mock_client, 1000, [VSC_HOME]), set(['vsc40075', 'vsc40002']))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.stats()['invalidated'], 4)
+
+        cache.invalidate(['vsc40003'], 'VscAccountPageUser')
+        self.assertFalse(cache.peek('VscTier2AccountpageUser', 'vsc40003') is None)
+        self.assertEqual(len(cache), 1)
+
+    def test_user_instances(self):
+
+        mock_client = mock.MagicMock()
+        cache = user.UserCache()
+        with mock.patch('vsc.administration.user._users_cache', cache):
+            test_account = mkVscAccount(test_account_1)
+            user.VscAccountPageUser(test_account.vsc_id, mock_client, account=test_account, use_user_cache=True)
+            accountpageuser = user.VscAccountPageUser(test_account.vsc_id, mock_client, use_user_cache=True)
+
+            self.assertEqual(accountpageuser.account, test_account)
+            mock_client.account[test_account.vsc_id].get.assert_not_called()
+            self.assertEqual(cache.stats()['hits'], 1)
+
+
+class PrefetchUsersTest(TestCase):
+    """
+    Tests for filling the user cache with the accountpage listings.
+    """
+
+    def tearDown(self):
+        user._users_cache.clear()
+        super(PrefetchUsersTest, self).tearDown()
+
+    def test_prefetch_users(self):
+
+        mock_client = mock.MagicMock()
+
+        # the given account records are used, nothing is fetched
+        self.assertEqual(user.prefetch_users(['vsc40075', 'vsc40003'], mock_client, accounts=[test_account_1]),
+                         ['vsc40075'])
+        mock_client.account.get.assert_not_called()
+
+        accountpageuser = user.VscTier2AccountpageUser('vsc40075', rest_client=mock_client, host_institute=GENT,
+                                                       use_user_cache=True)
+        self.assertEqual(accountpageuser.account, mkVscAccount(test_account_1))
+        mock_client.account['vsc40075'].get.assert_not_called()
+
+        # cached users are not fetched again
+        self.assertEqual(user.prefetch_users(['vsc40075'], mock_client, threshold=1), [])
+        mock_client.account.get.assert_not_called()
+
+    def test_prefetch_users_threshold(self):
+
+        mock_client = mock.MagicMock()
+        mock_client.account.get.return_value = (200, [test_account_1])
+
+        # too few users to fetch the complete listing
+        self.assertEqual(user.prefetch_users(['vsc40075', 'vsc40003'], mock_client, threshold=3), [])
+        mock_client.account.get.assert_not_called()
+
+        self.assertEqual(user.prefetch_users(['vsc40075', 'vsc40003'], mock_client, threshold=2), ['vsc40075'])
+        self.assertEqual(mock_client.account.get.call_count, 1)
+
+    def test_prefetch_users_failure(self):
+
+        mock_client = mock.MagicMock()
+        mock_client.account.get.side_effect = HTTPError("url", 404, "Not found", None, None)
+        mock_client.account['vsc40075'].get.return_value = (200, test_account_1)
+
+        self.assertEqual(user.prefetch_users(['vsc40075'], mock_client, threshold=1), [])
+
+        accountpageuser = user.VscTier2AccountpageUser('vsc40075', rest_client=mock_client, host_institute=GENT,
+                                                       use_user_cache=True)
+        self.assertEqual(accountpageuser.account, mkVscAccount(test_account_1))
+
 
 class UserDeploymentTest(TestCase):
     """
@@ -412,6 +556,33 @@ class UserDeploymentTest(TestCase):
         accountpageuser = user.VscTier2AccountpageUser(test_account.vsc_id, rest_client=mock_client, account=test_account, host_institute=GENT)
         accountpageuser.create_scratch_dir('VSC_SCRATCH_KYUKON')
 
+    @mock.patch('vsc.accountpage.client.AccountpageClient', autospec=True)
+    def test_process_users_concurrently(self, mock_client):
+
+        test_account_ids = ['vsc40075', 'vsc40123', 'vsc40039', 'vsc40002']
+        Options = namedtuple("Options", ['dry_run'])
+        options = Options(dry_run=False)
+
+        instances = {}
+
+        def make_user(vsc_id, **kwargs):
+            instance = mock.MagicMock()
+            instance.user_id = vsc_id
+            instance._get_grouping_path.return_value = ('/data/gent/%s' % vsc_id[:6], vsc_id[:6])
+            if vsc_id == 'vsc40123':
+                instance.create_data_dir.side_effect = Exception("cannot create %s" % vsc_id)
+            instances[vsc_id] = instance
+            return instance
+
+        with mock.patch('vsc.administration.user.VscTier2AccountpageUser', side_effect=make_user):
+            (ok_users, error_users) = user.process_users(options, test_account_ids, VSC_DATA, mock_client,
+                                                         use_user_cache=False, fs_workers=4)
+
+        self.assertEqual([u.user_id for u in ok_users], ['vsc40002', 'vsc40039', 'vsc40075'])
+        self.assertEqual([u.user_id for u in error_users], ['vsc40123'])
+        for instance in instances.values():
+            instance.create_data_dir.assert_called_once_with()
+
     @mock.patch('vsc.accountpage.client.AccountpageClient', autospec=True)
     def test_process_regular_users_quota(self, mock_client):
 
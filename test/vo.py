@@ -112,6 +112,50 @@ class VoDeploymentTest(TestCase):
                                                             self.assertEqual(mock_s_m_s_quota.called, True)
                                                             self.assertEqual(mock_cr_m_s_dir.called, True)
 
+    @mock.patch('vsc.accountpage.client.AccountpageClient', autospec=True)
+    def test_process_vos_quota_failure(self, mock_client):
+        """Test that members whose quota could not be written are reported as errors only."""
+
+        test_vo_id = "gvo00002"
+        Options = namedtuple("Options", ['dry_run'])
+        options = Options(dry_run=False)
+
+        mc = mock_client.return_value
+        mc.vo = mock.MagicMock()
+        date = "20321231"
+        mc.vo[test_vo_id].member.modified[date].get.return_value = (
+            200, [{u'vsc_id': u'vsc40075'}, {u'vsc_id': u'vsc40076'}])
+
+        context = mock.MagicMock()
+        context.quota_writer.flush.return_value = [(test_vo_id, 'vsc40075'), (test_vo_id, 'vsc40075')]
+
+        def mk_user(vsc_id, **kwargs):
+            member = mock.MagicMock()
+            member.account.vsc_id = vsc_id
+            return member
+
+        with mock.patch('vsc.administration.vo.VscTier2AccountpageUser', side_effect=mk_user):
+            with mock.patch('vsc.administration.vo.update_vo_status') as mock_update_vo_status:
+                with mock.patch.multiple(vo.VscTier2AccountpageVo, create_data_fileset=mock.DEFAULT,
+                                         set_data_quota=mock.DEFAULT, set_member_data_quota=mock.DEFAULT,
+                                         create_member_data_dir=mock.DEFAULT):
+                    ok, errors = vo.process_vos(options, [test_vo_id], VSC_DATA, mc, date, context=context)
+
+                    self.assertEqual(ok, {test_vo_id: ['vsc40076']})
+                    self.assertEqual(errors, {test_vo_id: ['vsc40075']})
+                    context.quota_writer.flush.assert_called_once_with()
+                    self.assertEqual(mock_update_vo_status.call_count, 1)
+
+                    # the VO quota failed, so the VO is not marked active
+                    mock_update_vo_status.reset_mock()
+                    context.quota_writer.flush.return_value = [(test_vo_id, None)]
+                    with mock.patch.object(vo.VscTier2AccountpageVo, 'members', return_value=['vsc40075', 'vsc40076']):
+                        ok, errors = vo.process_vos(options, [test_vo_id], VSC_DATA, mc, date, context=context)
+
+                    self.assertEqual(ok, {})
+                    self.assertEqual(errors, {test_vo_id: ['vsc40075', 'vsc40076']})
+                    self.assertFalse(mock_update_vo_status.called)
+
     @mock.patch('vsc.accountpage.client.AccountpageClient', autospec=True)
     @patch('vsc.administration.vo.VscStorage', autospec=True)
     def test_process_non_gent_institute_vos(self, mock_storage, mock_client):